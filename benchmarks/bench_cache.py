@@ -0,0 +1,138 @@
+"""
+Compare the legacy pickled request cache with the current body+metadata format.
+
+    python -m benchmarks.bench_cache [--pages 200] [--size 150000]
+
+Reports the average hit latency and the on-disk size of both formats, both loaded through the same path, and the
+latency of a full `CachingClient.get` hit with the memory cache disabled.
+"""
+import argparse
+import gzip
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+from datetime import timedelta
+from functools import partial
+
+import requests
+
+from prospects.http import CachingClient
+
+_LEGACY_SQL = """\
+CREATE TABLE requests (
+    identity TEXT PRIMARY KEY NOT NULL,
+    content BLOB NOT NULL,
+    timestamp REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def make_page(size, seed):
+    row = "<tr><td class='season'>2018-19</td><td class='team'>Team {}</td><td class='gp'>{}</td></tr>\n"
+    parts = []
+    total = 0
+    i = 0
+    while total < size:
+        part = row.format(seed, i)
+        parts.append(part)
+        total += len(part)
+        i += 1
+    return "<html><body><table>{}</table></body></html>".format("".join(parts)).encode()
+
+
+def make_response(url, body):
+    resp = requests.Response()
+    resp.url = url
+    resp.status_code = 200
+    resp.encoding = "utf-8"
+    resp.headers["content-type"] = "text/html; charset=utf-8"
+    resp._content = body
+    return resp
+
+
+def identity_of(client, url):
+    return client._compute_identity(requests.Request("GET", url).prepare())
+
+
+def populate_legacy(path, client, pages, size):
+    db = sqlite3.connect(path)
+    db.execute(_LEGACY_SQL)
+    now = time.time()
+    for i in range(pages):
+        url = "https://example.com/player/{}".format(i)
+        resp = make_response(url, make_page(size, i))
+        db.execute(
+            "INSERT INTO requests (identity, content, timestamp) VALUES (?, ?, ?)",
+            (identity_of(client, url), gzip.compress(pickle.dumps(resp)), now),
+        )
+    db.commit()
+    return db
+
+
+def populate_current(client, pages, size):
+    for i in range(pages):
+        url = "https://example.com/player/{}".format(i)
+        client._store(identity_of(client, url), make_response(url, make_page(size, i)))
+
+
+def load_legacy(db, identity):
+    content, = db.execute("SELECT content FROM requests WHERE identity = ?", (identity,)).fetchone()
+    return pickle.loads(gzip.decompress(content))
+
+
+def load_current(client, identity):
+    return client._load(identity)[0]
+
+
+def bench_load(load, client, pages):
+    # the same path for both formats: prepare the request, hash it, load the entry and decode the text
+    start = time.perf_counter()
+    for i in range(pages):
+        load(identity_of(client, "https://example.com/player/{}".format(i))).text
+    return (time.perf_counter() - start) / pages
+
+
+def bench_get(client, pages):
+    # the whole CachingClient.get hit path, with the bookkeeping of the last access
+    start = time.perf_counter()
+    for i in range(pages):
+        client.get("https://example.com/player/{}".format(i)).text
+    return (time.perf_counter() - start) / pages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--size", type=int, default=150000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        current_path = os.path.join(tmp, "current.db")
+
+        # the memory cache is disabled so that every get is served from SQLite
+        client = CachingClient(
+            path=current_path, cache_duration=timedelta(days=365), memory_entries=0, memory_bytes=0
+        )
+        populate_current(client, args.pages, args.size)
+
+        db = populate_legacy(legacy_path, client, args.pages, args.size)
+        legacy_latency = bench_load(partial(load_legacy, db), client, args.pages)
+        db.close()
+        legacy_size = os.path.getsize(legacy_path)
+
+        current_latency = bench_load(partial(load_current, client), client, args.pages)
+        get_latency = bench_get(client, args.pages)
+        client.close()
+        current_size = os.path.getsize(current_path)
+
+    print("format    hit latency    size on disk")
+    print("legacy    {:8.3f} ms    {:8.1f} kB".format(legacy_latency * 1000, legacy_size / 1024))
+    print("current   {:8.3f} ms    {:8.1f} kB".format(current_latency * 1000, current_size / 1024))
+    print("get()     {:8.3f} ms".format(get_latency * 1000))
+
+
+if __name__ == "__main__":
+    main()
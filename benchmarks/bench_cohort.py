@@ -0,0 +1,48 @@
+"""
+Measure the build and load time of the cohort index, and the latency of its percentile lookups.
+
+    python -m benchmarks.bench_cohort [--players 5000] [--lookups 100000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.bench_draft import seed
+from prospects.cohort import CohortIndex
+from prospects.models import Base, SCHEMA_VERSION, migrate
+from prospects.sqlite import SqliteDB
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SqliteDB(os.path.join(tmp, "players.db"), Base.metadata, version=SCHEMA_VERSION, migrate=migrate)
+        seed(db, args.players)
+
+        start = time.perf_counter()
+        CohortIndex.load(db)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = CohortIndex.load(db)
+        load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(args.lookups):
+        index.percentile("ppg", "QMJHL", 2018, 17, (i % 300) / 100)
+    lookup = time.perf_counter() - start
+
+    print("players   {}".format(args.players))
+    print("cohorts   {}".format(len(index.cohorts)))
+    print("build     {:.1f} ms".format(build * 1000))
+    print("load      {:.1f} ms".format(load * 1000))
+    print("lookup    {:.2f} us".format(lookup / args.lookups * 1e6))
+
+
+if __name__ == "__main__":
+    main()
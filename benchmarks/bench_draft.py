@@ -0,0 +1,61 @@
+"""
+Measure the latency and the number of queries of the draft report on a seeded database.
+
+    python -m benchmarks.bench_draft [--players 5000]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from benchmarks.bench_writer import make_player
+from prospects.generate import generate_draft
+from prospects.models import Base
+from prospects.sqlite import SqliteDB
+
+# players, drafts and stats, whatever the number of players
+EXPECTED_QUERIES = 3
+
+
+def seed(db, players, seasons=8):
+    with db.writer() as writer:
+        for i in range(players):
+            writer.add(make_player(i, seasons))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SqliteDB(os.path.join(tmp, "players.db"), Base.metadata)
+        seed(db, args.players)
+
+        queries = []
+
+        @event.listens_for(db._get_engine(), "before_cursor_execute")
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith("SELECT"):
+                queries.append(statement)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_draft(db, 2018)
+        elapsed = time.perf_counter() - start
+
+    print("players   {}".format(args.players))
+    print("queries   {}".format(len(queries)))
+    print("latency   {:.1f} ms".format(elapsed * 1000))
+
+    if len(queries) != EXPECTED_QUERIES:
+        sys.exit("expected {} queries, the report issued {}".format(EXPECTED_QUERIES, len(queries)))
+
+
+if __name__ == "__main__":
+    main()
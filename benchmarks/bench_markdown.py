@@ -0,0 +1,48 @@
+"""
+Measure how many table rows per second Table.render emits.
+
+    python -m benchmarks.bench_markdown [--rows 100000]
+"""
+import argparse
+import time
+
+from prospects.markdown import Document, Link, Table
+
+
+def make_table(rows):
+    t = Table()
+    t.add_columns("Player", "Season", "Team Name", "League Name", "GP", "Goals", "Assists", "Points", "+/-")
+    for i in range(rows):
+        t.add_row(
+            Link("Player {}".format(i), "https://www.eliteprospects.com/player/{}/player".format(i)),
+            "2018-19",
+            "Team {}".format(i % 30),
+            "QMJHL",
+            68,
+            i % 50,
+            i % 60,
+            i % 50 + i % 60,
+            None if i % 7 == 0 else i % 20 - 10,
+        )
+    return t
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    doc = Document()
+    doc.add(make_table(args.rows))
+
+    start = time.perf_counter()
+    text = doc.render()
+    elapsed = time.perf_counter() - start
+
+    print("rows      {}".format(args.rows))
+    print("size      {:.1f} kB".format(len(text) / 1024))
+    print("rows/sec  {:.0f}".format(args.rows / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measure the parse time of player pages.
+
+    python -m benchmarks.bench_parse [--repeat 5] [--parser lxml] [page.html ...]
+    python -m benchmarks.bench_parse --cache .request-cache.db
+
+Pages are either saved html pages, the skater and goalie pages of benchmarks/fixtures by default, or every player
+page of a request cache.
+"""
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+import time
+
+from prospects.http import _decompress
+from prospects.scrape import DEFAULT_PARSER, PLAYER_REGIONS, create_dom, parse_player_dom
+
+FIXTURES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "player-*.html")))
+
+
+def load_files(paths):
+    for path in paths:
+        with open(path, "rb") as f:
+            yield "https://www.eliteprospects.com/player/1/fixture", f.read().decode("utf-8", errors="replace")
+
+
+def load_cache(path):
+    db = sqlite3.connect(path)
+    for url, encoding, codec, body in db.execute(
+        "SELECT url, encoding, codec, body FROM requests WHERE url LIKE '%/player/%'"
+    ):
+        yield url, _decompress(codec, body).decode(encoding or "utf-8", errors="replace")
+
+
+def check_pages(pages, parser):
+    """
+    Every saved page must parse into a player with stat lines. The tables of the pages have several classes, such as
+    "table player-stats", which the regions must keep.
+    """
+    for url, html in pages:
+        try:
+            player = parse_player_dom(create_dom(html, parser, PLAYER_REGIONS), url)
+        except Exception as e:
+            sys.exit("failed to parse {}: {!r}".format(url, e))
+        if not player.stats:
+            sys.exit("no stat lines parsed from {}".format(url))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pages", nargs="*")
+    parser.add_argument("--cache")
+    parser.add_argument("--parser", default=DEFAULT_PARSER)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    paths = args.pages or ([] if args.cache else FIXTURES)
+    pages = list(load_files(paths))
+    check_pages(pages, args.parser)
+    if args.cache:
+        pages.extend(load_cache(args.cache))
+    if not pages:
+        parser.error("no pages to parse")
+
+    dom_time = 0.0
+    extract_time = 0.0
+    for _ in range(args.repeat):
+        for url, html in pages:
+            start = time.perf_counter()
+            doc = create_dom(html, args.parser, PLAYER_REGIONS)
+            mid = time.perf_counter()
+            parse_player_dom(doc, url)
+            end = time.perf_counter()
+            dom_time += mid - start
+            extract_time += end - mid
+
+    count = len(pages) * args.repeat
+    print("parser     {}".format(args.parser))
+    print("pages      {}".format(len(pages)))
+    print("dom        {:.2f} ms/page".format(dom_time / count * 1000))
+    print("extract    {:.2f} ms/page".format(extract_time / count * 1000))
+
+
+if __name__ == "__main__":
+    main()
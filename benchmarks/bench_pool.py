@@ -0,0 +1,60 @@
+"""
+Measure the latency and the number of queries of the pool report on a seeded database.
+
+    python -m benchmarks.bench_pool [--players 5000]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from benchmarks.bench_draft import seed
+from prospects.generate import generate_pool
+from prospects.models import Base, SCHEMA_VERSION, migrate
+from prospects.sqlite import SqliteDB
+
+# players and drafts, the fingerprint of the cohort index, and its build on the first run only
+EXPECTED_QUERIES = {"first": 4, "cached": 3}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=5000)
+    parser.add_argument("--season", type=int, default=2018)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SqliteDB(os.path.join(tmp, "players.db"), Base.metadata, version=SCHEMA_VERSION, migrate=migrate)
+        seed(db, args.players)
+
+        queries = []
+
+        @event.listens_for(db._get_engine(), "before_cursor_execute")
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith("SELECT"):
+                queries.append(statement)
+
+        results = []
+        for run in ("first", "cached"):
+            del queries[:]
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                generate_pool(db, args.season)
+            results.append((run, len(queries), time.perf_counter() - start))
+
+    print("players   {}".format(args.players))
+    for run, count, elapsed in results:
+        print("{:8}  {} queries, {:.1f} ms".format(run, count, elapsed * 1000))
+
+    for run, count, _ in results:
+        if count != EXPECTED_QUERIES[run]:
+            sys.exit("expected {} queries on the {} run, got {}".format(EXPECTED_QUERIES[run], run, count))
+
+
+if __name__ == "__main__":
+    main()
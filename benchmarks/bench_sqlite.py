@@ -0,0 +1,65 @@
+"""
+Measure the write throughput of the request cache and of the player database for each connection profile. The
+player database is measured with raw batched inserts, one transaction per batch.
+
+    python -m benchmarks.bench_sqlite [--entries 500] [--commits 500] [--batch 10]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.bench_writer import make_player
+from prospects.http import CachedResponse, CachingClient
+from prospects.models import Base, Player
+from prospects.pragmas import PROFILES
+from prospects.sqlite import SqliteDB, _row
+
+
+def bench_cache(path, profile, entries):
+    client = CachingClient(path=path, profile=profile)
+    body = b"<tr><td class='season'>2018-19</td><td class='gp'>68</td></tr>\n" * 2000
+    start = time.perf_counter()
+    for i in range(entries):
+        resp = CachedResponse(
+            url="https://example.com/player/{}".format(i),
+            status_code=200,
+            encoding="utf-8",
+            headers={},
+            content=body,
+        )
+        client._store(str(i), resp)
+    return entries / (time.perf_counter() - start)
+
+
+def bench_players(path, profile, commits, batch):
+    db = SqliteDB(path, Base.metadata, profile=profile)
+    player_table = Player.__table__
+    rows = [_row(player_table, make_player(i, 0)) for i in range(commits * batch)]
+    # raw inserts in small transactions, so that the journal and the syncs dominate rather than PlayerWriter
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch):
+        with db.transaction() as conn:
+            conn.execute(player_table.insert(), rows[i : i + batch])
+    return commits / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=500)
+    parser.add_argument("--commits", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=10, help="players inserted per transaction")
+    args = parser.parse_args()
+
+    print("profile   cache writes/s   player commits/s")
+    with tempfile.TemporaryDirectory() as tmp:
+        for profile in PROFILES:
+            cache_rate = bench_cache(os.path.join(tmp, "cache-{}.db".format(profile)), profile, args.entries)
+            player_rate = bench_players(
+                os.path.join(tmp, "players-{}.db".format(profile)), profile, args.commits, args.batch
+            )
+            print("{:8}  {:14.0f}   {:16.0f}".format(profile, cache_rate, player_rate))
+
+
+if __name__ == "__main__":
+    main()
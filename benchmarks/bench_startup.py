@@ -0,0 +1,63 @@
+"""
+Measure the startup time of the command line, and check that `--help` does not import the heavy dependencies.
+
+    python -m benchmarks.bench_startup [--repeat 5]
+
+Commands run in a temporary directory, `draft` against an empty but initialized players.db.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("bs4", "requests", "sqlalchemy", "prospects.scrape", "prospects.http")
+
+COMMANDS = [
+    ("--help", ["--help"]),
+    ("draft", ["draft", "2018"]),
+]
+
+
+def run(args, cwd):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "prospects"] + args,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+    # -X importtime lines end with the name of the module, indented by its nesting level
+    modules = {line.rsplit("|", 1)[-1].strip() for line in proc.stderr.splitlines() if line.startswith("import time:")}
+    return elapsed, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the first run creates the schema, it is not measured
+        run(["draft", "2018"], tmp)
+
+        print("command    median ms   heavy imports")
+        for name, command in COMMANDS:
+            times = []
+            for _ in range(args.repeat):
+                elapsed, modules = run(command, tmp)
+                times.append(elapsed)
+            heavy = sorted(m for m in HEAVY_MODULES if m in modules)
+            print("{:9}  {:9.0f}   {}".format(name, statistics.median(times) * 1000, ", ".join(heavy) or "-"))
+
+
+if __name__ == "__main__":
+    main()
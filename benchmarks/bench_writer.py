@@ -0,0 +1,86 @@
+"""
+Compare the per-player merge+commit persistence with the batched PlayerWriter.
+
+    python -m benchmarks.bench_writer [--players 50] [--seasons 8]
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import date
+
+from prospects.dto import Position, Shoots
+from prospects.models import Base, Draft, Player, StatLine
+from prospects.sqlite import SqliteDB
+
+
+def make_player(i, seasons):
+    player = Player(
+        name="Player {}".format(i),
+        birthday=date(2000, 1 + i % 12, 1 + i % 28),
+        nation="Canada",
+        birthplace="Montreal, QC, CAN",
+        position=Position.CENTER,
+        shoots=Shoots.LEFT,
+        height="6'0\" / 183 cm",
+        weight="185 lbs / 84 kg",
+        url="https://www.eliteprospects.com/player/{}/player-{}".format(100000 + i, i),
+        ep_id=100000 + i,
+        scouting_report="",
+    )
+    player.drafts.append(Draft(year=2018, round=1 + i % 7, overall=1 + i % 217, team="Montreal Canadiens"))
+    for season in range(seasons):
+        player.stats.append(
+            StatLine(
+                season_begin=2010 + season,
+                season_end=2011 + season,
+                team_name="Team",
+                league_name="QMJHL",
+                games=68,
+                is_tournament=False,
+                goals=20,
+                assists=30,
+                plus_minus=5,
+            )
+        )
+    return player
+
+
+def bench_merge(db, players):
+    start = time.perf_counter()
+    with db.session() as sess:
+        for player in players:
+            sess.merge(player)
+            sess.commit()
+    return time.perf_counter() - start
+
+
+def bench_writer(db, players):
+    start = time.perf_counter()
+    with db.writer() as writer:
+        for player in players:
+            writer.add(player)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=50)
+    parser.add_argument("--seasons", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SqliteDB(os.path.join(tmp, "merge.db"), Base.metadata)
+        merge_time = bench_merge(db, [make_player(i, args.seasons) for i in range(args.players)])
+
+        db = SqliteDB(os.path.join(tmp, "writer.db"), Base.metadata)
+        writer_time = bench_writer(db, [make_player(i, args.seasons) for i in range(args.players)])
+        rescrape_time = bench_writer(db, [make_player(i, args.seasons) for i in range(args.players)])
+
+    print("merge+commit  {:8.1f} ms".format(merge_time * 1000))
+    print("writer        {:8.1f} ms  ({:.1f}x)".format(writer_time * 1000, merge_time / writer_time))
+    print("re-scrape     {:8.1f} ms  (unchanged players)".format(rescrape_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,238 @@
 import logging
+import re
+import sys
+import time
+from datetime import timedelta
 
 import click
 
-from prospects.scrape import Scraper
-from prospects.sqlite import SqliteDB
-from prospects.models import Base
-from prospects.generate import generate_draft
+from prospects.pragmas import DEFAULT_PROFILE, PROFILES
 
-logging.basicConfig(level=logging.DEBUG)
+# the commands import what they use, so that `--help` and the reports do not pay for bs4, requests, etc.
+
+RE_DURATION = re.compile(r"^(\d+)([smhdw])$")
+RE_SIZE = re.compile(r"^(\d+)([kmg]?)b?$", re.IGNORECASE)
+DURATION_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def parse_duration(ctx, param, value):
+    match = RE_DURATION.match(value)
+    if not match:
+        raise click.BadParameter("expected a duration such as 12h, 30d or 8w")
+    return timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def parse_size(ctx, param, value):
+    match = RE_SIZE.match(value)
+    if not match:
+        raise click.BadParameter("expected a size such as 500k, 200M or 1G")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+
+
+def sqlite_profile():
+    # option of the group, read from the root context instead of being passed along by every command
+    return click.get_current_context().find_root().params["sqlite_profile"]
+
+
+def open_db():
+    from prospects.models import Base, SCHEMA_VERSION, migrate
+    from prospects.sqlite import SqliteDB
+
+    return SqliteDB("players.db", Base.metadata, version=SCHEMA_VERSION, migrate=migrate, profile=sqlite_profile())
+
+
+def open_cache(path):
+    from prospects.http import CachingClient
+
+    return CachingClient(path=path, profile=sqlite_profile())
 
 
 @click.group()
-def cli():
-    pass
+@click.option("-v", "--verbose", is_flag=True, help="log debug messages")
+@click.option(
+    "--sqlite-profile",
+    type=click.Choice(sorted(PROFILES)),
+    default=DEFAULT_PROFILE,
+    show_default=True,
+    help="connection settings of players.db and of the request cache, fast only syncs at WAL checkpoints",
+)
+def cli(verbose, sqlite_profile):
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+
+
+@cli.command(help="scrape info from the depth charts of teams, or of every team of a league")
+@click.argument("urls", nargs=-1)
+@click.option("--league", "leagues", multiple=True, help="league page whose teams are scraped, can be repeated")
+@click.option("--workers", type=int, default=4, show_default=True, help="number of fetching threads")
+@click.option("--flush-size", type=int, default=500, show_default=True, help="players written per transaction")
+@click.option("--parser", help="BeautifulSoup parser, lxml when installed, html.parser otherwise")
+@click.option("--processes", type=int, help="number of parsing processes, defaults to the number of cores")
+def scrape(urls, leagues, workers, flush_size, parser, processes):
+    from prospects.scrape import Scraper
+
+    if not urls and not leagues:
+        raise click.UsageError("give at least one depth chart url or --league")
+
+    db = open_db()
+    written = [0]
+
+    def progress(player_urls):
+        written[0] += len(player_urls)
+        click.echo("{} players written".format(written[0]), err=True)
+
+    with Scraper(
+        workers=workers, flush_size=flush_size, parser=parser, processes=processes, profile=sqlite_profile()
+    ) as scraper:
+        urls = list(urls)
+        for league in leagues:
+            urls.extend(url for url in scraper.parse_league(league) if url not in urls)
+
+        start = time.monotonic()
+        scraper.parse_depth_charts(db, urls, on_done=progress)
+        elapsed = time.monotonic() - start
+        memory = scraper.client_memory_stats()
+        stats = scraper.client_stats()
+
+    pages = sum(stats.values())
+    click.echo(
+        "{} players from {} teams, {} pages in {:.1f}s ({:.2f} pages/sec), cache hit rate {:.0%}".format(
+            written[0],
+            len(urls),
+            pages,
+            elapsed,
+            pages / elapsed if elapsed > 0 else 0,
+            (pages - stats.get("fetched", 0)) / pages if pages else 0,
+        ),
+        err=True,
+    )
+    click.echo("memory cache: {} hits, {} misses".format(memory["hits"], memory["misses"]), err=True)
+
 
+@cli.command("scrape-list", help="scrape the player urls listed in a file, resuming an interrupted run")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False), required=True)
+@click.option("--progress", "progress_path", default=".scrape-progress.db", show_default=True, help="progress database")
+@click.option("--retry-failed", is_flag=True, help="retry the urls which failed in a previous run")
+@click.option("--workers", type=int, default=4, show_default=True, help="number of fetching threads")
+@click.option("--flush-size", type=int, default=50, show_default=True, help="players written per transaction")
+@click.option("--processes", type=int, help="number of parsing processes, defaults to the number of cores")
+def scrape_list(path, progress_path, retry_failed, workers, flush_size, processes):
+    from prospects.progress import ProgressTracker, read_url_list
+    from prospects.scrape import Scraper
 
-@cli.command(help="scrape info from the depth chart of a team")
-@click.argument("url", required=True)
-def scrape(url):
-    db = SqliteDB("players.db", Base.metadata)
-    scraper = Scraper()
-    scraper.parse_depth_chart(db, url)
+    urls = read_url_list(path)
+    tracker = ProgressTracker(progress_path)
+    pending = tracker.pending(urls, retry_failed=retry_failed)
+    click.echo("{} urls, {} already scraped".format(len(urls), len(urls) - len(pending)), err=True)
 
+    db = open_db()
+    with Scraper(workers=workers, flush_size=flush_size, processes=processes, profile=sqlite_profile()) as scraper:
+        scraper.scrape_players(
+            db, [(url, None, None) for url in pending], on_done=tracker.mark_done, on_failed=tracker.mark_failed
+        )
+    click.echo(" ".join("{} {}".format(n, status) for status, n in sorted(tracker.counts().items())), err=True)
 
-@cli.command(help="scrape info from the depth chart of a team")
+
+@cli.command(help="generate the markdown report of the players drafted in a given year")
 @click.argument("year", type=int, required=True)
 def draft(year):
-    db = SqliteDB("players.db", Base.metadata)
+    from prospects.generate.draft import generate_draft
+
+    db = open_db()
     generate_draft(db, year)
 
 
+@cli.command(help="generate the markdown report of the players outside of the NHL, with NHL equivalent points")
+@click.argument("season", type=int, required=True)
+def pool(season):
+    from prospects.generate.pool import generate_pool
+
+    db = open_db()
+    generate_pool(db, season)
+
+
+@cli.command(help="rebuild the player database from the request cache without any network request")
+@click.option("--processes", type=int, help="number of parsing processes, defaults to the number of cores")
+@click.option("--parser", help="BeautifulSoup parser, lxml when installed, html.parser otherwise")
+def reparse(processes, parser):
+    from prospects.scrape import Scraper
+
+    db = open_db()
+    with Scraper(parser=parser, profile=sqlite_profile()) as scraper:
+        scraper.reparse(db, processes=processes)
+
+
+@cli.command(help="export the players with their drafts and stats as JSON")
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "json"]), default="ndjson", show_default=True)
+@click.option("--output", type=click.File("w", encoding="utf-8"), default="-", help="output file, stdout by default")
+def export(fmt, output):
+    from prospects.export import export_json, export_ndjson
+
+    db = open_db()
+    if fmt == "ndjson":
+        count = export_ndjson(db, output)
+    else:
+        count = export_json(db, output)
+    click.echo("{} players exported".format(count), err=True)
+
+
+@cli.command("explain-queries", help="print the query plan of the report queries, fails on full table scans")
+@click.option("--year", type=int, default=2018, show_default=True)
+def explain_queries(year):
+    from prospects.explain import explain, full_scans
+    from prospects.generate.draft import report_queries
+
+    db = open_db()
+    failed = False
+    with db.session() as sess:
+        for name, query in report_queries(sess, year):
+            plan = explain(sess, query)
+            click.echo("{}:".format(name))
+            for detail in plan:
+                click.echo("    {}".format(detail))
+            for detail in full_scans(plan):
+                click.echo("full table scan in {} query: {}".format(name, detail), err=True)
+                failed = True
+    if failed:
+        sys.exit(1)
+
+
+@cli.group(help="maintenance of the request cache")
+@click.option("--path", default=".request-cache.db", show_default=True, help="request cache database")
+@click.pass_context
+def cache(ctx, path):
+    ctx.obj = path
+
+
+@cache.command("stats", help="print statistics about the request cache")
+@click.pass_obj
+def cache_stats(path):
+    client = open_cache(path)
+    info = client.cache_info()
+    click.echo("entries      {}".format(info["entries"]))
+    click.echo("bodies       {:.1f} MB".format(info["body_size"] / 1024 ** 2))
+    click.echo(
+        "file         {:.1f} MB ({:.1f} MB free)".format(info["file_size"] / 1024 ** 2, info["free_size"] / 1024 ** 2)
+    )
+    click.echo("oldest       {}".format(info["oldest"]))
+    click.echo("newest       {}".format(info["newest"]))
+    for codec, count in sorted(info["codecs"].items()):
+        click.echo("codec {:6} {}".format(codec, count))
+
+
+@cache.command("prune", help="delete the entries older than the given duration")
+@click.option("--older-than", required=True, callback=parse_duration, help="duration such as 12h, 30d or 8w")
+@click.pass_obj
+def cache_prune(path, older_than):
+    click.echo("{} entries deleted".format(open_cache(path).prune(older_than)))
+
+
+@cache.command("limit", help="evict the least recently used entries above the given size")
+@click.option("--max-size", required=True, callback=parse_size, help="size such as 500k, 200M or 1G")
+@click.pass_obj
+def cache_limit(path, max_size):
+    click.echo("{} entries evicted".format(open_cache(path).limit(max_size)))
+
+
 if __name__ == "__main__":
     cli(prog_name="prospects")
@@ -0,0 +1,167 @@
+import logging
+import os
+import pickle
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+from sqlalchemy import column, func, select, table
+
+from .models import Player, SeasonSummary
+
+logger = logging.getLogger(__name__)
+
+# seasons with fewer games are left out of the cohorts, their averages are mostly noise
+MIN_GAMES = 10
+
+# metrics of the cohorts, GAA is the only one where a lower value is better
+METRICS = ("ppg", "gaa", "sv")
+LOWER_IS_BETTER = {"gaa"}
+
+# version of the file format of the cached index, bumped whenever the layout of the cohorts changes
+FORMAT_VERSION = 1
+
+# last id handed out for each AUTOINCREMENT table
+_sqlite_sequence = table("sqlite_sequence", column("name"), column("seq"))
+
+
+def cohort_age(birthday, season_end):
+    """
+    Age of a player on September 15th of the season, the cutoff used to define the draft classes.
+    """
+    if birthday is None:
+        return None
+    cutoff = date(season_end - 1, 9, 15)
+    return cutoff.year - birthday.year - ((cutoff.month, cutoff.day) < (birthday.month, birthday.day))
+
+
+def compute_fingerprint(conn):
+    """
+    Cheap aggregate of the season summaries which changes whenever the stat lines or the birthdays change, computed
+    in a single query. Refreshing the summaries of a player inserts rows with new ids, the last id handed out is
+    the change marker, the count covers the players whose summaries were only deleted.
+    """
+    summary_table = SeasonSummary.__table__
+    player_table = Player.__table__
+    sequence = select([_sqlite_sequence.c.seq]).where(_sqlite_sequence.c.name == summary_table.name).as_scalar()
+    players = select([func.count()]).select_from(player_table).as_scalar()
+    birthdays = select([func.total(func.julianday(player_table.c.birthday))]).as_scalar()
+    return tuple(
+        conn.execute(
+            select(
+                [
+                    sequence,
+                    func.count(),
+                    func.total(summary_table.c.id),
+                    func.total(summary_table.c.season_end),
+                    func.total(summary_table.c.is_tournament),
+                    func.total(summary_table.c.games),
+                    func.total(summary_table.c.goals),
+                    func.total(summary_table.c.assists),
+                    func.total(summary_table.c.plus_minus),
+                    func.total(summary_table.c.goal_average),
+                    func.total(summary_table.c.save_percent),
+                    players,
+                    birthdays,
+                ]
+            ).select_from(summary_table)
+        ).first()
+    )
+
+
+class CohortIndex:
+    """
+    Sorted values of each metric per (league, season, age) cohort, built in one pass over the season summaries.
+    Percentiles are answered with a binary search in the cohort.
+    """
+
+    def __init__(self, cohorts, fingerprint=None):
+        self.cohorts = cohorts
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, conn, fingerprint=None):
+        summary_table = SeasonSummary.__table__
+        player_table = Player.__table__
+        query = (
+            select(
+                [
+                    summary_table.c.league_name,
+                    summary_table.c.season_end,
+                    summary_table.c.games,
+                    summary_table.c.goals,
+                    summary_table.c.assists,
+                    summary_table.c.goal_average,
+                    summary_table.c.save_percent,
+                    player_table.c.birthday,
+                ]
+            )
+            .select_from(summary_table.join(player_table, player_table.c.id == summary_table.c.player_id))
+            .where(~summary_table.c.is_tournament)
+            .where(summary_table.c.games >= MIN_GAMES)
+        )
+
+        values = {}
+        for row in conn.execute(query):
+            age = cohort_age(row.birthday, row.season_end)
+            if age is None:
+                continue
+            key = (row.league_name, row.season_end, age)
+            if row.goals is not None and row.assists is not None:
+                values.setdefault(key + ("ppg",), []).append((row.goals + row.assists) / row.games)
+            if row.goal_average is not None:
+                values.setdefault(key + ("gaa",), []).append(row.goal_average)
+            if row.save_percent is not None:
+                values.setdefault(key + ("sv",), []).append(row.save_percent)
+
+        cohorts = {key: array("d", sorted(metric_values)) for key, metric_values in values.items()}
+        return cls(cohorts, fingerprint if fingerprint is not None else compute_fingerprint(conn))
+
+    @classmethod
+    def load(cls, db, path=None):
+        """
+        Load the index cached next to the database, it is rebuilt and saved again when the stats have changed.
+        """
+        if path is None:
+            path = db.path + ".cohorts"
+
+        with db.transaction() as conn:
+            current = compute_fingerprint(conn)
+            try:
+                with open(path, "rb") as f:
+                    data = pickle.load(f)
+                if data["version"] == FORMAT_VERSION and tuple(data["fingerprint"]) == current:
+                    return cls(data["cohorts"], current)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                # a cache written by another version of the code or truncated, it is simply rebuilt
+                logger.debug("ignoring unreadable cohort index %s", path, exc_info=True)
+
+            logger.debug("rebuilding the cohort index %s", path)
+            index = cls.build(conn, current)
+
+        # only builtin types and arrays are stored, the file does not depend on the classes of this module
+        data = {"version": FORMAT_VERSION, "fingerprint": index.fingerprint, "cohorts": index.cohorts}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return index
+
+    def cohort(self, metric, league, season_end, age):
+        return self.cohorts.get(((league or "").upper(), season_end, age, metric), ())
+
+    def percentile(self, metric, league, season_end, age, value):
+        """
+        Percentage of the cohort the value is better than, ties count for half. None when the cohort is empty.
+        """
+        if metric not in METRICS:
+            raise ValueError("unknown metric: " + metric)
+        values = self.cohort(metric, league, season_end, age)
+        if value is None or not values:
+            return None
+        rank = (bisect_left(values, value) + bisect_right(values, value)) / 2
+        if metric in LOWER_IS_BETTER:
+            rank = len(values) - rank
+        return round(rank / len(values) * 100)
@@ -1,5 +1,7 @@
 import enum
 
+from attr import attrs, attrib
+
 
 class Position(enum.Enum):
     CENTER = 1
@@ -60,6 +62,57 @@ class Shoots(enum.Enum):
             return "R"
 
 
+# Plain records produced by the scraper. Unlike the ORM models they can be pickled cheaply, which allows
+# parsing in worker processes. Attributes are named like the columns of the matching models.
+
+
+@attrs(slots=True, kw_only=True)
+class DraftRecord:
+    year = attrib()
+    round = attrib()
+    overall = attrib()
+    team = attrib()
+
+
+@attrs(slots=True, kw_only=True)
+class StatRecord:
+    season_begin = attrib(default=None)
+    season_end = attrib(default=None)
+    team_name = attrib(default=None)
+    league_name = attrib(default=None)
+    games = attrib(default=None)
+    is_tournament = attrib(default=None)
+
+    goals = attrib(default=None)
+    assists = attrib(default=None)
+    plus_minus = attrib(default=None)
+
+    goal_average = attrib(default=None)
+    save_percent = attrib(default=None)
+
+
+@attrs(slots=True, kw_only=True)
+class PlayerRecord:
+    ep_id = attrib(default=None)
+    name = attrib(default=None)
+    birthday = attrib(default=None)
+    nation = attrib(default=None)
+    birthplace = attrib(default=None)
+
+    position = attrib(default=None)
+    shoots = attrib(default=None)
+    height = attrib(default=None)
+    height_cm = attrib(default=None)
+    weight = attrib(default=None)
+    weight_kg = attrib(default=None)
+
+    url = attrib(default=None)
+    scouting_report = attrib(default=None)
+
+    drafts = attrib(factory=list)
+    stats = attrib(factory=list)
+
+
 # @attrs(slots=True, kw_only=True)
 # class Player:
 #     name = attrib()
@@ -0,0 +1,27 @@
+import re
+
+from .models import Base
+
+# "SCAN TABLE x" on older SQLite versions, "SCAN x" on newer ones. A scan through an index, reported with a
+# "USING [COVERING] INDEX" suffix, still reads every row of the table, only SEARCH steps are bounded.
+RE_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)\b")
+
+
+def explain(sess, query):
+    """
+    Return the details of the `EXPLAIN QUERY PLAN` output of an ORM query.
+    """
+    sql = str(query.statement.compile(dialect=sess.bind.dialect, compile_kwargs={"literal_binds": True}))
+    return [row[-1] for row in sess.execute("EXPLAIN QUERY PLAN " + sql)]
+
+
+def full_scans(plan):
+    """
+    Return the plan steps which scan a whole table of the schema, with or without an index.
+    """
+    scans = []
+    for detail in plan:
+        match = RE_FULL_SCAN.match(detail)
+        if match and match.group(1) in Base.metadata.tables:
+            scans.append(detail)
+    return scans
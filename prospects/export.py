@@ -0,0 +1,82 @@
+import enum
+import json
+from datetime import date
+
+from sqlalchemy import select
+
+from .models import Draft, Player, StatLine
+
+
+def _value(val):
+    if isinstance(val, enum.Enum):
+        return str(val)
+    if isinstance(val, date):
+        return val.isoformat()
+    return val
+
+
+def _to_dict(table, row, exclude=()):
+    return {col.key: _value(row[col]) for col in table.columns if col.key not in exclude}
+
+
+def _children(rows, player_id, pending):
+    """
+    Consume the rows of a stream ordered by player_id which belong to `player_id`. `pending` holds the first row
+    of the next player, read ahead from the stream.
+    """
+    items = []
+    row = pending[0]
+    while row is not None and row.player_id <= player_id:
+        if row.player_id == player_id:
+            items.append(row)
+        row = next(rows, None)
+    pending[0] = row
+    return items
+
+
+def iter_players(conn):
+    """
+    Yield every player as a dict with its drafts and stat lines. Players, drafts and stat lines are read by three
+    cursors ordered by player id and merged on the fly, so memory use does not grow with the size of the database.
+    """
+    player_table = Player.__table__
+    draft_table = Draft.__table__
+    stat_table = StatLine.__table__
+
+    players = conn.execute(select([player_table]).order_by(player_table.c.id))
+    drafts = iter(conn.execute(select([draft_table]).order_by(draft_table.c.player_id, draft_table.c.year)))
+    stats = iter(conn.execute(select([stat_table]).order_by(stat_table.c.player_id, stat_table.c.id)))
+    pending_drafts = [next(drafts, None)]
+    pending_stats = [next(stats, None)]
+
+    for row in players:
+        player = _to_dict(player_table, row)
+        player["drafts"] = [
+            _to_dict(draft_table, d, exclude=("id", "player_id")) for d in _children(drafts, row.id, pending_drafts)
+        ]
+        player["stats"] = [
+            _to_dict(stat_table, s, exclude=("id", "player_id")) for s in _children(stats, row.id, pending_stats)
+        ]
+        yield player
+
+
+def export_ndjson(db, stream):
+    count = 0
+    with db.transaction() as conn:
+        for player in iter_players(conn):
+            stream.write(json.dumps(player, ensure_ascii=False))
+            stream.write("\n")
+            count += 1
+    return count
+
+
+def export_json(db, stream):
+    count = 0
+    with db.transaction() as conn:
+        stream.write("[")
+        for player in iter_players(conn):
+            stream.write(",\n" if count else "\n")
+            stream.write(json.dumps(player, ensure_ascii=False))
+            count += 1
+        stream.write("\n]\n")
+    return count
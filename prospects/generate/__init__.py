@@ -1,3 +1,4 @@
 from prospects.generate.draft import generate_draft
+from prospects.generate.pool import generate_pool
 
-__all__ = ["generate_draft"]
+__all__ = ["generate_draft", "generate_pool"]
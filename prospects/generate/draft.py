@@ -1,55 +1,102 @@
+import sys
+from itertools import groupby
+
 from sqlalchemy import func
-from sqlalchemy.sql import and_
 
-from prospects.markdown import Document, Table, List
+from prospects.markdown import StreamingDocument, Table, List
 from prospects.models import Player, Draft, StatLine
 
 
-def generate_draft(db, year):
-    with db.session() as sess:
-        players = (
-            sess.query(Player)
-            .filter(sess.query(Draft).filter(and_(Draft.year == year, Draft.player_id == Player.id)).exists())
-            .order_by(sess.query(func.min(Draft.overall)).filter(Draft.player_id == Player.id))
-        )
+def query_players(sess, year):
+    drafted = sess.query(Draft.player_id).filter(Draft.year == year)
+    # best pick of the drafted players only, a group by over the whole draft table would scan it
+    best_pick = (
+        sess.query(Draft.player_id.label("player_id"), func.min(Draft.overall).label("overall"))
+        .filter(Draft.player_id.in_(drafted))
+        .group_by(Draft.player_id)
+        .subquery()
+    )
+    return (
+        sess.query(Player)
+        .join(best_pick, best_pick.c.player_id == Player.id)
+        .order_by(best_pick.c.overall)
+    )
+
+
+def query_drafts(sess, year):
+    drafted = sess.query(Draft.player_id).filter(Draft.year == year)
+    return sess.query(Draft).filter(Draft.player_id.in_(drafted)).order_by(Draft.player_id, Draft.year)
+
+
+def query_stats(sess, year):
+    drafted = sess.query(Draft.player_id).filter(Draft.year == year)
+    return (
+        sess.query(StatLine)
+        .filter(StatLine.season_end == year)
+        .filter(StatLine.player_id.in_(drafted))
+        .order_by(StatLine.player_id, StatLine.is_tournament, StatLine.id)
+    )
 
-        doc = Document()
 
-        for player in players:
-            drafts = list(sorted(player.drafts, key=lambda d: d.year))
-            doc.add(List(items=["{} #{}".format(player.name, drafts[0].overall)]))
+def report_queries(sess, year):
+    """
+    Queries issued by the draft report, used by `explain` to audit their query plans.
+    """
+    return [
+        ("players", query_players(sess, year)),
+        ("drafts", query_drafts(sess, year)),
+        ("stats", query_stats(sess, year)),
+    ]
 
-            t = Table()
-            t.add_columns("Name", "Age", "Birthday", "Nation", "Position", "Shoots", "Height", "Weight")
+
+def iter_draft(players, drafts_by_player, stats_by_player):
+    for player in players:
+        yield List(items=["{} #{}".format(player.name, drafts_by_player[player.id][0].overall)])
+
+        t = Table()
+        t.add_columns("Name", "Age", "Birthday", "Nation", "Position", "Shoots", "Height", "Weight")
+        t.add_row(
+            player.name,
+            player.age,
+            player.birthday,
+            player.nation,
+            player.position,
+            player.shoots,
+            player.height,
+            player.weight,
+        )
+        yield t
+
+        t = Table()
+        t.add_columns("Tournament", "Team Name", "League Name", "GP", "Goals", "Assists", "Points", "+/-")
+
+        for stat in stats_by_player.get(player.id, []):
             t.add_row(
-                player.name,
-                player.age,
-                player.birthday,
-                player.nation,
-                player.position,
-                player.shoots,
-                player.height,
-                player.weight,
+                "\u2611" if stat.is_tournament else "\u2610",
+                stat.team_name,
+                stat.league_name,
+                stat.games,
+                stat.goals,
+                stat.assists,
+                stat.points,
+                stat.plus_minus,
             )
-            doc.add(t)
 
-            stats = player.stats.filter(StatLine.season_end == year).order_by(StatLine.is_tournament)
+        yield t
 
-            t = Table()
-            t.add_columns("Tournament", "Team Name", "League Name", "GP", "Goals", "Assists", "Points", "+/-")
 
-            for stat in stats:
-                t.add_row(
-                    "\u2611" if stat.is_tournament else "\u2610",
-                    stat.team_name,
-                    stat.league_name,
-                    stat.games,
-                    stat.goals,
-                    stat.assists,
-                    stat.points,
-                    stat.plus_minus,
-                )
+def generate_draft(db, year, stream=None):
+    if stream is None:
+        stream = sys.stdout
 
-            doc.add(t)
+    with db.session() as sess:
+        # 3 queries whatever the number of players: players ordered by their best pick, their drafts, and their
+        # stats for the year. The drafts are not loaded with selectinload, which issues a query per 500 players.
+        players = query_players(sess, year).all()
+        drafts = query_drafts(sess, year)
+        drafts_by_player = {player_id: list(rows) for player_id, rows in groupby(drafts, key=lambda d: d.player_id)}
+        stats = query_stats(sess, year)
+        stats_by_player = {player_id: list(rows) for player_id, rows in groupby(stats, key=lambda s: s.player_id)}
 
-        print(doc.render())
+        StreamingDocument(iter_draft(players, drafts_by_player, stats_by_player)).render(stream)
+        stream.write("\n")
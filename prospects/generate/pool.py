@@ -1,50 +1,12 @@
-from .dto import Position, Shoots
-from .markdown import Document, Table, H2, Link
+import sys
+from itertools import groupby
 
+from sqlalchemy import case, func
 
-def filter_player_func(player):
-    stats = filter_stats(player)
-    main_stats = max(stats, key=lambda s: s.games)
-    return main_stats.league_name != "NHL"
-
-
-def filter_player(players):
-    return list(filter(filter_player_func, players))
-
-
-def filter_stats(player, year=2018):
-    return [stats for stats in player.stats if stats.season_end == year]
-
-
-def get_skater_stats(skater):
-    # merge stats by league
-    # take league with most games played
-    leagues = {}
-
-    # merge stats by league
-    for stats in filter_stats(skater):
-        league = stats.league_name.upper()
-        if league not in leagues:
-            pass
-        else:
-            agg_stats = leagues[league]
-            agg_stats.team_name.append(stats.team_name)
-            agg_stats.games += stats.games
-            agg_stats.goals += stats.goals
-            agg_stats.assists += stats.assists
-            agg_stats.plus_minus += stats.plus_minus
-
-    # finalize team_name
-    for stats in leagues.values():
-        stats.team_name = " / ".join(stats.team_name)
-
-    # pick best league by games
-    return max(leagues.values(), key=lambda stats: stats.games)
-
-
-def get_goalie_stats(goalie):
-    return max(filter_stats(goalie), key=lambda stats: stats.games)
-
+from prospects.cohort import CohortIndex, cohort_age
+from prospects.dto import Position, Shoots
+from prospects.markdown import StreamingDocument, Table, H2, Link
+from prospects.models import Draft, Player, SeasonSummary
 
 # https://twitter.com/robvollmannhl/status/866477120360402944
 TRANSLATION_FACTOR = {
@@ -61,120 +23,182 @@ TRANSLATION_FACTOR = {
 }
 
 
-def get_points_translation(player):
-    games = 0
-    points = 0
-    for stats in filter_stats(player):
-        league = stats.league_name.upper()
-        factor = TRANSLATION_FACTOR.get(league)
-        if factor is None:
-            continue
-        points += factor * stats.points
-        games += stats.games
-    if games == 0:
-        return None
-    else:
-        return round(points / games * 82, 1)
-
-
-def render(players):
-    players = filter_player(players)
-
-    lw = []
-    center = []
-    rw = []
-    lhd = []
-    rhd = []
-    goalie = []
-
-    for player in players:
-        if Position.DEFENSE == player.position:
-            if player.shoots == Shoots.LEFT:
-                lhd.append(player)
-            else:
-                rhd.append(player)
-        elif Position.LEFT_WING == player.position:
-            lw.append(player)
-        elif Position.RIGHT_WING == player.position:
-            rw.append(player)
-        elif Position.CENTER == player.position:
-            center.append(player)
-        elif Position.GOALIE == player.position:
-            goalie.append(player)
-
-    def generate_skater_table(players):
-        t = Table()
-        t.add_columns(
-            "Player",
-            "Age",
-            "Height",
-            "Weight",
-            "League",
-            "Games",
-            "Goals",
-            "Assists",
-            "Points",
-            "PPG",
-            "Drafted",
-            "PT/82",
+def query_translations(sess, season):
+    """
+    NHL equivalent points per 82 games of every player for the season, computed by SQLite in a single aggregate
+    over the season summaries of the leagues with a translation factor.
+    """
+    factor = case(TRANSLATION_FACTOR, value=SeasonSummary.league_name)
+    points = func.coalesce(SeasonSummary.goals, 0) + func.coalesce(SeasonSummary.assists, 0)
+    games = func.nullif(func.sum(SeasonSummary.games), 0)
+    return (
+        sess.query(
+            SeasonSummary.player_id.label("player_id"),
+            func.round(func.sum(factor * points) * 82 / games, 1).label("points_82"),
         )
-        for player in players:
-            stats = get_skater_stats(player)
-            t.add_row(
-                Link(player.name, player.url),
-                player.age_frac,
-                player.height_imp,
-                player.weight_imp,
-                stats.league_name,
-                stats.games,
-                stats.goals,
-                stats.assists,
-                stats.points,
-                stats.points_per_game,
-                player.draft.short if player.draft is not None else "",
-                get_points_translation(player) or "",
-            )
-        return t
-
-    def generate_goalie_table(goalies):
-        t = Table()
-        t.add_columns("Player", "Age", "Height", "Weight", "League", "Games", "GAA", "SV%", "Drafted")
-        for player in goalies:
-            stats = get_goalie_stats(player)
-            t.add_row(
-                Link(player.name, player.url),
-                player.age_frac,
-                player.height_imp,
-                player.weight_imp,
-                stats.league_name,
-                stats.games,
-                stats.goal_average,
-                stats.save_percent,
-                player.draft.short if player.draft is not None else "",
-            )
-        return t
-
-    doc = Document()
-
-    doc.add(H2("Left wingers"))
-    doc.add(generate_skater_table(lw))
-
-    doc.add(H2("Centers"))
-    doc.add(generate_skater_table(center))
-
-    doc.add(H2("Right wingers"))
-    doc.add(generate_skater_table(rw))
-
-    doc.add(H2("Left-handed defensemen"))
-    doc.add(generate_skater_table(lhd))
-
-    doc.add(H2("Right-handed defensemen"))
-    doc.add(generate_skater_table(rhd))
-
-    doc.add(H2("Goaltenders"))
-    doc.add(generate_goalie_table(goalie))
-
-    return doc.render()
-
-
-__all__ = ["render"]
+        .filter(SeasonSummary.season_end == season)
+        .filter(SeasonSummary.league_name.in_(list(TRANSLATION_FACTOR)))
+        .group_by(SeasonSummary.player_id)
+    )
+
+
+def filter_pool(query, season):
+    # players whose primary league of the season is not the NHL
+    return (
+        query.filter(SeasonSummary.season_end == season)
+        .filter(SeasonSummary.is_primary)
+        .filter(SeasonSummary.league_name != "NHL")
+    )
+
+
+def query_pool(sess, season):
+    """
+    Players outside of the NHL with their primary league of the season and their translated points.
+    """
+    translations = query_translations(sess, season).subquery()
+    query = (
+        sess.query(Player, SeasonSummary, translations.c.points_82)
+        .join(SeasonSummary, SeasonSummary.player_id == Player.id)
+        .outerjoin(translations, translations.c.player_id == Player.id)
+    )
+    return filter_pool(query, season).order_by(
+        translations.c.points_82.is_(None), translations.c.points_82.desc(), Player.name
+    )
+
+
+def imperial(measure):
+    # "6'0\" / 183 cm" -> "6'0\""
+    return measure.split("/")[0].strip() if measure else ""
+
+
+def query_drafts(sess, season):
+    pool = filter_pool(sess.query(SeasonSummary.player_id), season)
+    return sess.query(Draft).filter(Draft.player_id.in_(pool)).order_by(Draft.player_id, Draft.year)
+
+
+def drafted(drafts):
+    if not drafts:
+        return ""
+    draft = drafts[-1]
+    return "{} #{}".format(draft.year, draft.overall)
+
+
+def percentile(index, metric, player, summary, value):
+    # percentile among the players of the same age in the same league and season
+    age = cohort_age(player.birthday, summary.season_end)
+    return index.percentile(metric, summary.league_name, summary.season_end, age, value)
+
+
+def skater_table(rows, drafts_by_player, index):
+    t = Table()
+    t.add_columns(
+        "Player",
+        "Age",
+        "Height",
+        "Weight",
+        "League",
+        "Games",
+        "Goals",
+        "Assists",
+        "Points",
+        "PPG",
+        "PPG %ile",
+        "Drafted",
+        "PT/82",
+    )
+    for player, summary, points_82 in rows:
+        ppg = summary.points / summary.games if summary.games and summary.points is not None else None
+        t.add_row(
+            Link(player.name, player.url),
+            player.age,
+            imperial(player.height),
+            imperial(player.weight),
+            summary.league_name,
+            summary.games,
+            summary.goals,
+            summary.assists,
+            summary.points,
+            summary.points_per_game,
+            percentile(index, "ppg", player, summary, ppg),
+            drafted(drafts_by_player.get(player.id)),
+            points_82 if points_82 is not None else "",
+        )
+    return t
+
+
+def goalie_table(rows, drafts_by_player, index):
+    t = Table()
+    t.add_columns("Player", "Age", "Height", "Weight", "League", "Games", "GAA", "SV%", "SV% %ile", "Drafted")
+    for player, summary, _ in rows:
+        t.add_row(
+            Link(player.name, player.url),
+            player.age,
+            imperial(player.height),
+            imperial(player.weight),
+            summary.league_name,
+            summary.games,
+            summary.goal_average,
+            summary.save_percent,
+            percentile(index, "sv", player, summary, summary.save_percent),
+            drafted(drafts_by_player.get(player.id)),
+        )
+    return t
+
+
+def group_rows(rows):
+    groups = {"lw": [], "center": [], "rw": [], "lhd": [], "rhd": [], "goalie": []}
+    for row in rows:
+        player = row[0]
+        if player.position == Position.DEFENSE:
+            groups["lhd" if player.shoots == Shoots.LEFT else "rhd"].append(row)
+        elif player.position == Position.LEFT_WING:
+            groups["lw"].append(row)
+        elif player.position == Position.RIGHT_WING:
+            groups["rw"].append(row)
+        elif player.position == Position.CENTER:
+            groups["center"].append(row)
+        elif player.position == Position.GOALIE:
+            groups["goalie"].append(row)
+    return groups
+
+
+def iter_pool(groups, drafts_by_player, index):
+    yield H2("Left wingers")
+    yield skater_table(groups["lw"], drafts_by_player, index)
+
+    yield H2("Centers")
+    yield skater_table(groups["center"], drafts_by_player, index)
+
+    yield H2("Right wingers")
+    yield skater_table(groups["rw"], drafts_by_player, index)
+
+    yield H2("Left-handed defensemen")
+    yield skater_table(groups["lhd"], drafts_by_player, index)
+
+    yield H2("Right-handed defensemen")
+    yield skater_table(groups["rhd"], drafts_by_player, index)
+
+    yield H2("Goaltenders")
+    yield goalie_table(groups["goalie"], drafts_by_player, index)
+
+
+def generate_pool(db, season, stream=None):
+    if stream is None:
+        stream = sys.stdout
+
+    with db.session() as sess:
+        # 2 queries whatever the number of players: players with their summary and translated points, and their
+        # drafts. The drafts are not loaded with selectinload, which issues a query per 500 players.
+        rows = query_pool(sess, season).all()
+        drafts = query_drafts(sess, season)
+        drafts_by_player = {
+            player_id: list(player_drafts) for player_id, player_drafts in groupby(drafts, key=lambda d: d.player_id)
+        }
+
+    # 1 more query for the fingerprint of the cohort index, and 1 to rebuild it when the stats changed
+    index = CohortIndex.load(db)
+    StreamingDocument(iter_pool(group_rows(rows), drafts_by_player, index)).render(stream)
+    stream.write("\n")
+
+
+__all__ = ["generate_pool"]
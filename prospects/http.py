@@ -4,35 +4,342 @@ import logging
 import pickle
 import random
 import sqlite3
+import threading
 import time
+import zlib
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .pragmas import apply_pragmas
 
 logger = logging.getLogger(__name__)
 
+SCHEMA_VERSION = 2
+
 _TABLES_SQL = """\
 CREATE TABLE IF NOT EXISTS requests (
     identity TEXT PRIMARY KEY NOT NULL,
-    content BLOB NOT NULL,
-    timestamp REAL NOT NULL
+    timestamp REAL NOT NULL,
+    url TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    encoding TEXT,
+    content_type TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    codec TEXT NOT NULL,
+    body BLOB NOT NULL,
+    accessed REAL
 ) WITHOUT ROWID;
 """
 
+ZLIB_LEVEL = 6
+# last access times are only needed by `limit`, they are written in batches so that cache hits stay read-only
+ACCESSED_FLUSH_SIZE = 100
+ZSTD_LEVEL = 3
+
+
+def _compress(data):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return "zlib", zlib.compress(data, ZLIB_LEVEL)
+
+
+def _decompress(codec, data):
+    if codec == "zlib":
+        return zlib.decompress(data)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise ValueError("cache entry is zstd compressed but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raise ValueError("unknown cache codec %s" % codec)
+
+
+class CachedResponse:
+    """
+    Lightweight stand-in for `requests.Response`, it only keeps what the scraper needs.
+    """
+
+    __slots__ = ("url", "status_code", "encoding", "headers", "content", "_text")
+
+    def __init__(self, *, url, status_code, encoding, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.encoding = encoding
+        self.headers = headers
+        self.content = content
+        self._text = None
+
+    @classmethod
+    def from_response(cls, resp):
+        headers = CaseInsensitiveDict()
+        for name in ("content-type", "etag", "last-modified"):
+            if name in resp.headers:
+                headers[name] = resp.headers[name]
+        return cls(
+            url=resp.url,
+            status_code=resp.status_code,
+            encoding=resp.encoding or resp.apparent_encoding,
+            headers=headers,
+            content=resp.content,
+        )
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.content.decode(self.encoding or "utf-8", errors="replace")
+        return self._text
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError("{} error for url: {}".format(self.status_code, self.url), response=self)
+
+
+class MemoryCache:
+    """
+    Bounded in-process LRU of decoded responses, keyed by request identity. Entries are evicted once there are
+    more than `max_entries` of them or their bodies take more than `max_bytes`. Safe to use from several threads.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 ** 2):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, identity, cutoff):
+        """
+        Return the response stored under `identity` if it was fetched after the `cutoff` timestamp.
+        """
+        with self._lock:
+            entry = self._entries.get(identity)
+            if entry is None or entry[1] <= cutoff:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(identity)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, identity, resp, timestamp):
+        size = len(resp.content)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(identity, None)
+            if old is not None:
+                self._bytes -= len(old[0].content)
+            self._entries[identity] = (resp, timestamp)
+            self._bytes += size
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.content)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes}
+
+
+class RateLimiter:
+    """
+    Per-host token bucket. Each host gets `burst` tokens which refill at one token every `delay` seconds.
+    `acquire` reserves a slot under a lock and sleeps outside of it, so concurrent callers are scheduled
+    one after the other instead of all waking up at the same time.
+    """
+
+    def __init__(self, delay=0.0, *, jitter=True, burst=1):
+        self._delay = delay
+        self._jitter = jitter
+        self._burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _next_delay(self):
+        delay = self._delay
+        if self._jitter:
+            offset = self._delay * 0.25
+            delay += random.uniform(-offset, offset)
+        return delay
+
+    def acquire(self, host):
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(host, (self._burst, now))
+            if self._delay > 0:
+                tokens = min(self._burst, tokens + (now - updated) / self._delay)
+            else:
+                tokens = self._burst
+
+            if tokens >= 1:
+                sleep_for = 0.0
+                tokens -= 1
+                updated = now
+            else:
+                # reserve the slot at which the next token becomes available
+                sleep_for = (1 - tokens) * self._delay
+                tokens = 0
+                updated = now + sleep_for
+
+            # jitter is applied by shifting the refill clock of the bucket
+            updated += self._next_delay() - self._delay
+            self._buckets[host] = (tokens, updated)
+
+        if sleep_for > 0:
+            logger.debug("waiting %.2f before requesting %s", sleep_for, host)
+            time.sleep(sleep_for)
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
 
 class CachingClient:
-    def __init__(self, *, path=".request-cache.db", cache_duration=timedelta(days=1), delay=0.0, jitter=True):
-        self._db = sqlite3.connect(path)
-        self._db.execute(_TABLES_SQL)
-        self._db.commit()
+    def __init__(
+        self,
+        *,
+        path=".request-cache.db",
+        cache_duration=timedelta(days=1),
+        delay=0.0,
+        jitter=True,
+        memory_entries=256,
+        memory_bytes=64 * 1024 ** 2,
+        profile=None,
+        pool_size=10
+    ):
+        self._path = path
+        self._profile = profile
+        # sqlite3 connections cannot be shared between threads, each thread gets its own
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # SQLite only allows one writer at a time, serializing writes here avoids busy timeouts
+        self._write_lock = threading.Lock()
+        # identity -> last access time not written yet, guarded by the write lock
+        self._accessed = {}
+        self._memory = MemoryCache(memory_entries, memory_bytes)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._migrate()
         self._session = requests.Session()
         self._session.headers.update(
             {"user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:67.0) Gecko/20100101 Firefox/67.0"}
         )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
         self._cache_duration = cache_duration
-        self._delay = delay
-        self._jitter = jitter
-        self._wait_until = time.monotonic()
+        self._limiter = RateLimiter(delay, jitter=jitter)
+        self._stats_lock = threading.Lock()
+        self._stats = Counter()
+
+    @property
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # used by its thread only, the check is disabled so that close() can be called from any thread
+            conn = sqlite3.connect(self._path, timeout=30, check_same_thread=False)
+            apply_pragmas(conn, self._profile)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def flush(self):
+        """
+        Write the last access times which are still buffered.
+        """
+        with self._write_lock:
+            if self._accessed:
+                self._flush_accessed()
+                self._db.commit()
+
+    def close(self):
+        self.flush()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+        self._session.close()
+
+    def _count(self, event):
+        with self._stats_lock:
+            self._stats[event] += 1
+
+    def stats(self):
+        """
+        Counts of cache `hit`s, `not_modified` revalidations, `fetched` documents and requests `coalesced` with an
+        identical in-flight request since the client was created.
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def memory_stats(self):
+        return self._memory.stats()
+
+    def _migrate(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'requests'").fetchone()
+        if exists is None:
+            # must be set before the first table is created to take effect without a full VACUUM
+            self._db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+        with self._db:
+            self._db.execute("BEGIN")
+            if version < 1 and exists is not None:
+                self._db.execute("ALTER TABLE requests RENAME TO requests_legacy")
+                self._db.execute(_TABLES_SQL)
+                self._migrate_legacy()
+                self._db.execute("DROP TABLE requests_legacy")
+            elif version < 2 and exists is not None:
+                # version 2 tracks the last access of each entry for LRU eviction
+                self._db.execute("ALTER TABLE requests ADD COLUMN accessed REAL")
+                self._db.execute("UPDATE requests SET accessed = timestamp")
+            self._db.execute(_TABLES_SQL)
+            self._db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+
+        if self._db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.info("enabling incremental vacuum on the request cache, this rewrites the whole file once")
+            self._db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._db.execute("VACUUM")
+
+    def _migrate_legacy(self):
+        # version 0 stored a gzipped pickle of the whole requests.Response
+        count = 0
+        rows = self._db.execute("SELECT identity, content, timestamp FROM requests_legacy")
+        for identity, content, timestamp in rows:
+            try:
+                resp = pickle.loads(gzip.decompress(content))
+            except Exception:
+                logger.warning("dropping unreadable cache entry %s", identity)
+                continue
+            self._insert(identity, CachedResponse.from_response(resp), timestamp)
+            count += 1
+        logger.info("migrated %d cache entries to schema version %d", count, SCHEMA_VERSION)
 
     def _compute_identity(self, prepped):
         hasher = hashlib.sha1()
@@ -42,38 +349,224 @@ class CachingClient:
             hasher.update(prepped.headers[header])
         return hasher.hexdigest()
 
+    def _decode_row(self, url, status, encoding, content_type, etag, last_modified, codec, body):
+        headers = CaseInsensitiveDict()
+        for name, value in (("content-type", content_type), ("etag", etag), ("last-modified", last_modified)):
+            if value is not None:
+                headers[name] = value
+        return CachedResponse(
+            url=url, status_code=status, encoding=encoding, headers=headers, content=_decompress(codec, body)
+        )
+
+    def _load(self, identity):
+        """
+        Load a cached response, stale or not. Returns `(response, timestamp)` or `None`.
+        """
+        cur = self._db.execute(
+            "SELECT timestamp, url, status, encoding, content_type, etag, last_modified, codec, body"
+            " FROM requests WHERE identity = ?",
+            (identity,),
+        )
+        res = cur.fetchone()
+        if res is None:
+            return None
+        timestamp, *row = res
+        return self._decode_row(*row), timestamp
+
+    def iter_cached(self, url_pattern="%"):
+        """
+        Iterate over the cached responses whose url matches the LIKE pattern, stale or not. Never does any
+        network request.
+        """
+        rows = self._db.execute(
+            "SELECT url, status, encoding, content_type, etag, last_modified, codec, body"
+            " FROM requests WHERE url LIKE ? ORDER BY url",
+            (url_pattern,),
+        )
+        for row in rows:
+            yield self._decode_row(*row)
+
+    def _insert(self, identity, resp, timestamp):
+        codec, body = _compress(resp.content)
+        self._db.execute(
+            "INSERT OR REPLACE INTO requests"
+            " (identity, timestamp, url, status, encoding, content_type, etag, last_modified, codec, body, accessed)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                identity,
+                timestamp,
+                resp.url,
+                resp.status_code,
+                resp.encoding,
+                resp.headers.get("content-type"),
+                resp.headers.get("etag"),
+                resp.headers.get("last-modified"),
+                codec,
+                body,
+                timestamp,
+            ),
+        )
+
+    def _store(self, identity, resp):
+        now = datetime.utcnow().timestamp()
+        with self._write_lock:
+            self._flush_accessed()
+            self._insert(identity, resp, now)
+            self._db.commit()
+        return now
+
+    def _touch(self, identity):
+        now = datetime.utcnow().timestamp()
+        with self._write_lock:
+            self._flush_accessed()
+            self._db.execute("UPDATE requests SET timestamp = ?, accessed = ? WHERE identity = ?", (now, now, identity))
+            self._db.commit()
+        return now
+
+    def _mark_accessed(self, identity):
+        with self._write_lock:
+            self._accessed[identity] = datetime.utcnow().timestamp()
+            if len(self._accessed) >= ACCESSED_FLUSH_SIZE:
+                self._flush_accessed()
+                self._db.commit()
+
+    def _flush_accessed(self):
+        # the lock must be held by the caller, the updates are committed with the caller's transaction
+        if self._accessed:
+            self._db.executemany(
+                "UPDATE requests SET accessed = ? WHERE identity = ?",
+                [(accessed, identity) for identity, accessed in self._accessed.items()],
+            )
+            self._accessed = {}
+
+    def cache_info(self):
+        """
+        Return statistics about the content of the cache.
+        """
+        entries, body_size, oldest, newest = self._db.execute(
+            "SELECT count(*), coalesce(sum(length(body)), 0), min(timestamp), max(timestamp) FROM requests"
+        ).fetchone()
+        page_size = self._db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self._db.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self._db.execute("PRAGMA freelist_count").fetchone()[0]
+        codecs = dict(self._db.execute("SELECT codec, count(*) FROM requests GROUP BY codec"))
+        return {
+            "entries": entries,
+            "body_size": body_size,
+            "file_size": page_size * page_count,
+            "free_size": page_size * free_pages,
+            "oldest": datetime.utcfromtimestamp(oldest) if oldest is not None else None,
+            "newest": datetime.utcfromtimestamp(newest) if newest is not None else None,
+            "codecs": codecs,
+        }
+
+    def _vacuum(self):
+        # the lock must be held by the caller. executescript is used since the sqlite3 module only steps once
+        # through statements without result columns, which would free a single page.
+        self._db.executescript("PRAGMA incremental_vacuum;")
+
+    def prune(self, older_than):
+        """
+        Delete the entries fetched or revalidated more than `older_than` ago. Returns the number of entries deleted.
+        """
+        cutoff = (datetime.utcnow() - older_than).timestamp()
+        with self._write_lock:
+            count = self._db.execute("DELETE FROM requests WHERE timestamp < ?", (cutoff,)).rowcount
+            self._db.commit()
+            self._vacuum()
+        return count
+
+    def limit(self, max_size):
+        """
+        Evict the least recently used entries until the compressed bodies fit in `max_size` bytes. Returns the
+        number of entries deleted.
+        """
+        with self._write_lock:
+            self._flush_accessed()
+            total = 0
+            evicted = []
+            for identity, size in self._db.execute(
+                "SELECT identity, length(body) FROM requests ORDER BY accessed DESC"
+            ).fetchall():
+                total += size
+                if total > max_size:
+                    evicted.append((identity,))
+            self._db.executemany("DELETE FROM requests WHERE identity = ?", evicted)
+            self._db.commit()
+            self._vacuum()
+        return len(evicted)
+
     def get(self, url, params=None, **kwargs):
         req = requests.Request("GET", url, params, **kwargs)
         prepped = req.prepare()
         identity = self._compute_identity(prepped)
         cutoff = (datetime.utcnow() - self._cache_duration).timestamp()
 
-        cur = self._db.execute("SELECT content FROM requests WHERE identity = ? AND timestamp > ?", (identity, cutoff))
-        res = cur.fetchone()
-        if res is not None:
-            logger.debug("loaded url from cache %s", prepped.url)
+        resp = self._memory.get(identity, cutoff)
+        if resp is not None:
+            logger.debug("loaded url from memory %s", prepped.url)
+            self._count("hit")
+            return resp
 
-            return pickle.loads(gzip.decompress(res[0]))
-        else:
-            logger.debug("fetching document %s", prepped.url)
+        # single-flight: concurrent callers missing the memory cache for the same request wait for the first
+        # one instead of each going through the rate limiter and downloading the page
+        with self._inflight_lock:
+            flight = self._inflight.get(identity)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[identity] = flight
 
-            sleep_for = max(0, self._wait_until - time.monotonic())
-            time.sleep(sleep_for)
+        if not leader:
+            logger.debug("waiting for in-flight request %s", prepped.url)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            self._count("coalesced")
+            return flight.result
 
-            resp = self._session.send(prepped)
+        try:
+            flight.result = self._get(identity, prepped, cutoff)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[identity]
+            flight.done.set()
 
-            delay = self._delay
-            if self._jitter:
-                offset = self._delay * 0.25
-                delay += random.uniform(-offset, offset)
+    def _get(self, identity, prepped, cutoff):
+        cached = self._load(identity)
+        if cached is not None:
+            cached_resp, timestamp = cached
+            if timestamp > cutoff:
+                logger.debug("loaded url from cache %s", prepped.url)
+                self._count("hit")
+                self._mark_accessed(identity)
+                self._memory.put(identity, cached_resp, timestamp)
+                return cached_resp
 
-            logger.debug("delay of %.2f for next request", delay)
-            self._wait_until = time.monotonic() + self._delay
+            # stale entry, ask the server if it changed instead of downloading it blindly
+            if "etag" in cached_resp.headers:
+                prepped.headers["If-None-Match"] = cached_resp.headers["etag"]
+            if "last-modified" in cached_resp.headers:
+                prepped.headers["If-Modified-Since"] = cached_resp.headers["last-modified"]
 
-            resp.raise_for_status()
-            self._db.execute(
-                "INSERT OR REPLACE INTO requests (identity, content, timestamp) VALUES (?, ?, ?)",
-                (identity, gzip.compress(pickle.dumps(resp)), datetime.utcnow().timestamp()),
-            )
-            self._db.commit()
-            return resp
+        # cache hits never go through the rate limiter, only network requests are delayed
+        self._limiter.acquire(urlsplit(prepped.url).netloc)
+
+        logger.debug("fetching document %s", prepped.url)
+        resp = self._session.send(prepped)
+
+        if resp.status_code == 304 and cached is not None:
+            logger.debug("document not modified %s", prepped.url)
+            self._memory.put(identity, cached_resp, self._touch(identity))
+            self._count("not_modified")
+            return cached_resp
+
+        resp.raise_for_status()
+        resp = CachedResponse.from_response(resp)
+        self._memory.put(identity, resp, self._store(identity, resp))
+        self._count("fetched")
+        return resp
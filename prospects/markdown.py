@@ -14,8 +14,8 @@ def escape(url):
 
 
 class Buffer:
-    def __init__(self):
-        self._inner = StringIO()
+    def __init__(self, stream=None):
+        self._inner = StringIO() if stream is None else stream
 
     def write(self, text):
         self._inner.write(text)
@@ -34,18 +34,50 @@ class Document:
     def add(self, item):
         self.items.append(item)
 
-    def render(self):
-        b = Buffer()
+    def render(self, stream=None):
+        """
+        Render the document to `stream` element by element, or return it as a string if no stream is given.
+        """
+        b = Buffer(stream)
         for item in self.items:
             if isinstance(item, Element):
                 item.render(b)
-        return b.text()
+        if stream is None:
+            return b.text()
+
+
+class StreamingDocument(Document):
+    """
+    Document whose elements come from an iterable, usually a generator. Each element is written to the stream
+    as soon as it is produced and is not kept around afterwards.
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+    def add(self, item):
+        raise TypeError("cannot add items to a streaming document")
+
+    def render(self, stream=None):
+        if stream is None:
+            return super().render()
+        b = Buffer(stream)
+        for item in self.items:
+            if isinstance(item, Element):
+                item.render(b)
+                if hasattr(stream, "flush"):
+                    stream.flush()
 
 
 class Element:
     def render(self, writer: Buffer):
         pass
 
+    def to_string(self):
+        b = Buffer()
+        self.render(b)
+        return b.text()
+
 
 class _Heading(Element):
     def __init__(self, text, *, size):
@@ -98,11 +130,10 @@ class Link(Element):
         self.url = url
 
     def render(self, w):
-        w.write("[")
-        w.write(self.text)
-        w.write("](")
-        w.write(escape(self.url))
-        w.write(")")
+        w.write(self.to_string())
+
+    def to_string(self):
+        return "[{}]({})".format(self.text, escape(self.url))
 
 
 class List(Element):
@@ -129,15 +160,37 @@ class List(Element):
         w.write("\n")
 
 
+_ALIGNMENTS = {"center": ":---:", "left": ":---", "right": "---:"}
+
+
+def format_cell(item):
+    if item is None:
+        return "-"
+    elif isinstance(item, Element):
+        return item.to_string()
+    else:
+        return str(item)
+
+
 class Table(Element):
     def __init__(self):
         self.columns = []
         self.alignments = []
+        self.formatters = []
         self.rows = []
-
-    def add_column(self, name, *, align="center"):
+        self._header = None
+
+    def add_column(self, name, *, align="center", fmt=format_cell):
+        """
+        Add a column, `fmt` is the function used to turn the cells of the column into text.
+        """
+        align = align.lower()
+        if align not in _ALIGNMENTS:
+            raise ValueError("invalid value for alignment %s" % align)
         self.columns.append(name)
-        self.alignments.append(align.lower())
+        self.alignments.append(align)
+        self.formatters.append(fmt)
+        self._header = None
 
     def add_columns(self, *columns):
         for col in columns:
@@ -146,35 +199,21 @@ class Table(Element):
     def add_row(self, *args):
         self.rows.append(tuple(args))
 
-    def render(self, w):
-        for first, column in iter_first(self.columns):
-            if not first:
-                w.write("|")
-            w.write(column)
-        w.write("\n")
+    def _get_header(self):
+        if self._header is None:
+            self._header = "{}\n{}\n".format(
+                "|".join(self.columns), "|".join(_ALIGNMENTS[align] for align in self.alignments)
+            )
+        return self._header
 
-        for first, align in iter_first(self.alignments):
-            if not first:
-                w.write("|")
-            if align == "center":
-                w.write(":---:")
-            elif align == "left":
-                w.write(":---")
-            elif align == "right":
-                w.write("---:")
-            else:
-                raise ValueError("invalid value for alignment %s" % align)
-        w.write("\n")
+    def render(self, w):
+        w.write(self._get_header())
 
+        formatters = self.formatters
+        width = len(formatters)
         for row in self.rows:
-            for first, item in iter_first(row):
-                if not first:
-                    w.write("|")
-                if isinstance(item, Element):
-                    item.render(w)
-                elif item is None:
-                    w.write("-")
-                else:
-                    w.write(str(item))
-            w.write("\n")
+            if len(row) == width:
+                w.write("|".join([fmt(item) for fmt, item in zip(formatters, row)]) + "\n")
+            else:
+                w.write("|".join([format_cell(item) for item in row]) + "\n")
         w.write("\n")
@@ -1,6 +1,7 @@
+import re
 from datetime import date
 
-from sqlalchemy import Boolean, Column, Integer, Float, Text, Date, Enum, ForeignKey
+from sqlalchemy import Boolean, Column, Integer, Float, Text, Date, Enum, ForeignKey, Index, select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -8,12 +9,33 @@ from .dto import Position, Shoots
 
 Base = declarative_base()
 
+SCHEMA_VERSION = 4
+
+RE_PLAYER_URL = re.compile(r"/player/(\d+)")
+
+
+def ep_id_from_url(url):
+    """
+    Extract the EliteProspects player id from a player url.
+    """
+    match = RE_PLAYER_URL.search(url)
+    if not match:
+        raise ValueError("invalid player url: " + url)
+    return int(match.group(1))
+
 
 class Draft(Base):
     __tablename__ = "draft"
+    __table_args__ = (
+        # drafts of a player, and the best pick of a player with min(overall)
+        Index("ix_draft_player_year_overall", "player_id", "year", "overall"),
+        # players drafted in a given year
+        Index("ix_draft_year_overall_player", "year", "overall", "player_id"),
+    )
+    natural_key = ("year",)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    player_id = Column(Integer, ForeignKey("player.id"), index=True)
+    player_id = Column(Integer, ForeignKey("player.id"))
     player = relationship("Player", back_populates="drafts")
 
     year = Column(Integer)
@@ -24,9 +46,14 @@ class Draft(Base):
 
 class StatLine(Base):
     __tablename__ = "stat_line"
+    __table_args__ = (
+        # stats of a player for a given season
+        Index("ix_stat_line_player_season", "player_id", "season_end", "is_tournament"),
+    )
+    natural_key = ("season_begin", "team_name", "league_name", "is_tournament")
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    player_id = Column(Integer, ForeignKey("player.id"), index=True)
+    player_id = Column(Integer, ForeignKey("player.id"))
     player = relationship("Player", back_populates="stats")
 
     season_begin = Column(Integer)
@@ -56,6 +83,7 @@ class Player(Base):
     __tablename__ = "player"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
+    ep_id = Column(Integer, unique=True, index=True)
 
     name = Column(Text)
     birthday = Column(Date)
@@ -72,10 +100,178 @@ class Player(Base):
     url = Column(Text)
     scouting_report = Column(Text)
 
-    drafts = relationship("Draft", back_populates="player", lazy="dynamic")
-    stats = relationship("StatLine", back_populates="player", lazy="dynamic")
+    # plain collections so that callers can choose to eager load them with selectinload/joinedload
+    drafts = relationship("Draft", back_populates="player", order_by="Draft.year")
+    stats = relationship("StatLine", back_populates="player", order_by="StatLine.id")
+    season_summaries = relationship("SeasonSummary", back_populates="player", order_by="SeasonSummary.season_end")
 
     @property
     def age(self):
         age_delta = date.today() - self.birthday
         return round(age_delta.days / 365.242199, 1)
+
+
+class SeasonSummary(Base):
+    """
+    Stat lines of a player merged by season and league, maintained by `refresh_season_summary` whenever the stat
+    lines of the player are written. Ids are never reused, the last one handed out tells when the summaries changed.
+    """
+
+    __tablename__ = "season_summary"
+    __table_args__ = (
+        Index("ix_season_summary_player_season", "player_id", "season_end", "league_name", unique=True),
+        {"sqlite_autoincrement": True},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    player_id = Column(Integer, ForeignKey("player.id"))
+    player = relationship("Player", back_populates="season_summaries")
+
+    season_end = Column(Integer)
+    league_name = Column(Text)  # upper case
+    team_name = Column(Text)  # teams of the league joined by " / "
+    is_tournament = Column(Boolean)
+    # league in which the player played the most games that season, tournaments only count without other leagues
+    is_primary = Column(Boolean)
+
+    games = Column(Integer)
+    goals = Column(Integer)
+    assists = Column(Integer)
+    plus_minus = Column(Integer)
+
+    # averages weighted by games played
+    goal_average = Column(Float)
+    save_percent = Column(Float)
+
+    @property
+    def points(self):
+        if self.goals is None or self.assists is None:
+            return None
+        return self.goals + self.assists
+
+    @property
+    def points_per_game(self):
+        if not self.games or self.points is None:
+            return None
+        return round(self.points / self.games, 2)
+
+
+def _sum(values):
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def _weighted_average(lines, attr):
+    pairs = [(getattr(line, attr), line.games or 0) for line in lines if getattr(line, attr) is not None]
+    games = sum(g for _, g in pairs)
+    if not pairs:
+        return None
+    if games == 0:
+        return round(sum(v for v, _ in pairs) / len(pairs), 3)
+    return round(sum(v * g for v, g in pairs) / games, 3)
+
+
+def summarize_season(player_id, season_end, lines):
+    """
+    Merge the stat lines of a player for one season into one season summary row per league.
+    """
+    leagues = {}
+    for line in lines:
+        leagues.setdefault((line.league_name or "").upper(), []).append(line)
+
+    rows = []
+    for league, league_lines in leagues.items():
+        teams = []
+        for line in league_lines:
+            if line.team_name not in teams:
+                teams.append(line.team_name)
+        rows.append(
+            dict(
+                player_id=player_id,
+                season_end=season_end,
+                league_name=league,
+                team_name=" / ".join(t for t in teams if t),
+                is_tournament=all(line.is_tournament for line in league_lines),
+                is_primary=False,
+                games=_sum(line.games for line in league_lines) or 0,
+                goals=_sum(line.goals for line in league_lines),
+                assists=_sum(line.assists for line in league_lines),
+                plus_minus=_sum(line.plus_minus for line in league_lines),
+                goal_average=_weighted_average(league_lines, "goal_average"),
+                save_percent=_weighted_average(league_lines, "save_percent"),
+            )
+        )
+
+    if rows:
+        primary = max(rows, key=lambda row: (not row["is_tournament"], row["games"]))
+        primary["is_primary"] = True
+    return rows
+
+
+def refresh_season_summary(conn, player_ids):
+    """
+    Rebuild the season summary rows of the given players from their stat lines.
+    """
+    stat_table = StatLine.__table__
+    summary_table = SeasonSummary.__table__
+
+    for i in range(0, len(player_ids), 500):
+        chunk = player_ids[i : i + 500]
+        lines = conn.execute(
+            select([stat_table])
+            .where(stat_table.c.player_id.in_(chunk))
+            .order_by(stat_table.c.player_id, stat_table.c.season_end, stat_table.c.id)
+        ).fetchall()
+
+        seasons = {}
+        for line in lines:
+            seasons.setdefault((line.player_id, line.season_end), []).append(line)
+
+        rows = []
+        for (player_id, season_end), season_lines in seasons.items():
+            rows.extend(summarize_season(player_id, season_end, season_lines))
+
+        conn.execute(summary_table.delete().where(summary_table.c.player_id.in_(chunk)))
+        if rows:
+            conn.execute(summary_table.insert(), rows)
+
+
+def migrate(conn, version):
+    """
+    Upgrade a database created with schema `version` to `SCHEMA_VERSION`. Runs after `create_all`.
+    """
+    if version < 1:
+        # version 1 adds the EliteProspects id as the natural key of players and removes the duplicates
+        # inserted by previous runs, keeping the most recent row of each player.
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(player)")}
+        if "ep_id" not in columns:
+            conn.execute("ALTER TABLE player ADD COLUMN ep_id INTEGER")
+        for player_id, url in conn.execute("SELECT id, url FROM player WHERE ep_id IS NULL").fetchall():
+            conn.execute("UPDATE player SET ep_id = ? WHERE id = ?", (ep_id_from_url(url), player_id))
+        stale = "SELECT id FROM player WHERE id NOT IN (SELECT max(id) FROM player GROUP BY ep_id)"
+        conn.execute("DELETE FROM draft WHERE player_id IN ({})".format(stale))
+        conn.execute("DELETE FROM stat_line WHERE player_id IN ({})".format(stale))
+        conn.execute("DELETE FROM player WHERE id IN ({})".format(stale))
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_player_ep_id ON player (ep_id)")
+
+    if version < 2:
+        # version 2 replaces the foreign key indexes with composite indexes matching the report queries
+        conn.execute("DROP INDEX IF EXISTS ix_draft_player_id")
+        conn.execute("DROP INDEX IF EXISTS ix_stat_line_player_id")
+        for table in (Draft.__table__, StatLine.__table__):
+            for index in table.indexes:
+                columns = ", ".join(col.name for col in index.columns)
+                conn.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(index.name, table.name, columns))
+
+    if version < 3:
+        # version 3 adds the season summaries, created by create_all, they are built for every existing player
+        refresh_season_summary(conn, [row[0] for row in conn.execute("SELECT id FROM player")])
+
+    if version < 4:
+        # version 4 creates the season summaries with AUTOINCREMENT, which SQLite only accepts when the table is
+        # created: a table from version 3 is recreated and filled again
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'season_summary'").scalar()
+        if "AUTOINCREMENT" not in sql.upper():
+            SeasonSummary.__table__.drop(conn)
+            SeasonSummary.__table__.create(conn)
+            refresh_season_summary(conn, [row[0] for row in conn.execute("SELECT id FROM player")])
@@ -0,0 +1,43 @@
+"""
+Connection settings shared by the SQLite databases of the project, the request cache and the player database.
+
+* `safe` keeps every commit durable (synchronous=FULL), WAL only removes the rollback journal writes.
+* `fast` only syncs at WAL checkpoints (synchronous=NORMAL). A power loss can lose the last commits but never
+  corrupts the database, which is fine for data that can be scraped again. It also memory maps the file and
+  uses a larger page cache.
+* `none` leaves the SQLite defaults.
+"""
+
+PROFILES = {
+    "none": [],
+    "safe": [
+        ("journal_mode", "WAL"),
+        ("synchronous", "FULL"),
+        ("cache_size", -16000),
+        ("temp_store", "MEMORY"),
+    ],
+    "fast": [
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("mmap_size", 256 * 1024 ** 2),
+        ("cache_size", -64000),
+        ("temp_store", "MEMORY"),
+    ],
+}
+
+DEFAULT_PROFILE = "fast"
+
+
+def apply_pragmas(dbapi_connection, profile=None):
+    """
+    Apply the pragmas of a profile to a sqlite3 connection.
+    """
+    try:
+        pragmas = PROFILES[profile or DEFAULT_PROFILE]
+    except KeyError:
+        raise ValueError("unknown sqlite profile: {}".format(profile))
+    cur = dbapi_connection.cursor()
+    for name, value in pragmas:
+        # journal_mode returns the resulting mode, its row must be consumed
+        cur.execute("PRAGMA {} = {}".format(name, value)).fetchall()
+    cur.close()
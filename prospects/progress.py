@@ -0,0 +1,73 @@
+import sqlite3
+import threading
+from datetime import datetime
+
+_TABLES_SQL = """\
+CREATE TABLE IF NOT EXISTS progress (
+    url TEXT PRIMARY KEY NOT NULL,
+    status TEXT NOT NULL,
+    timestamp REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+DONE = "done"
+FAILED = "failed"
+
+
+def read_url_list(path):
+    """
+    Read a file containing one url per line, blank lines and lines starting with # are ignored.
+    """
+    urls = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                urls.append(line)
+    return urls
+
+
+class ProgressTracker:
+    """
+    Records the status of each url of a bulk scrape so that an interrupted run can resume where it stopped.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path=".scrape-progress.db"):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(_TABLES_SQL)
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def pending(self, urls, retry_failed=False):
+        """
+        Return the urls which are not done yet, in their original order.
+        """
+        statuses = [DONE] if retry_failed else [DONE, FAILED]
+        with self._lock:
+            finished = {
+                row[0]
+                for row in self._db.execute(
+                    "SELECT url FROM progress WHERE status IN ({})".format(", ".join("?" for _ in statuses)), statuses
+                )
+            }
+        return [url for url in urls if url not in finished]
+
+    def mark(self, urls, status):
+        timestamp = datetime.utcnow().timestamp()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO progress (url, status, timestamp) VALUES (?, ?, ?)",
+                ((url, status, timestamp) for url in urls),
+            )
+            self._db.commit()
+
+    def mark_done(self, urls):
+        self.mark(urls, DONE)
+
+    def mark_failed(self, url):
+        self.mark([url], FAILED)
+
+    def counts(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT status, count(*) FROM progress GROUP BY status"))
@@ -1,23 +1,49 @@
 import logging
+import os
+import queue
 import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from bs4.element import Tag
 
-from .dto import Position, Shoots
-from .models import Draft, StatLine, Player
+try:
+    import lxml  # noqa: F401
+
+    DEFAULT_PARSER = "lxml"
+except ImportError:
+    DEFAULT_PARSER = "html.parser"
+
+from .dto import DraftRecord, PlayerRecord, Position, Shoots, StatRecord
+from .models import ep_id_from_url
 from .http import CachingClient
 
 RE_PLAYER_PATTERN = re.compile(r"(.+)\s+\(([^\)]+)\)")
 RE_SEASON_PATTERN = re.compile(r"(\d\d\d\d)\-(\d\d)")
+RE_TEAM_URL = re.compile(r"^(https?://[^/]+/team/\d+/[^/?#]+)")
 
 logger = logging.getLogger(__name__)
-client = CachingClient(delay=15)
 
 
-def create_dom(html):
-    return BeautifulSoup(html, "html.parser")
+def class_pattern(*classes):
+    """
+    Pattern matching tags having any of the classes. While the page is parsed, a SoupStrainer compares `class_`
+    with the whole attribute value, such as "table player-stats", so each class is matched as a token of it.
+    """
+    return re.compile(r"(?:^|\s)(?:{})(?:\s|$)".format("|".join(map(re.escape, classes))))
+
+
+# only the regions of the pages used by the scraper are built into a tree
+PLAYER_REGIONS = SoupStrainer(class_=class_pattern("table-view", "dtl-txt", "plytitle", "player-stats"))
+DEPTH_CHART_REGIONS = SoupStrainer("table", class_=class_pattern("depth-chart"))
+
+
+def create_dom(html, parser=None, parse_only=None):
+    return BeautifulSoup(html, parser or DEFAULT_PARSER, parse_only=parse_only)
 
 
 def get_element_text(elem):
@@ -69,53 +95,77 @@ def is_injured(stats_row):
     return len(stats_row.find_all("i", class_="fa-injured")) > 0
 
 
-def parse_skater_stats(seasons, player):
-    for row in seasons:
-        season_str = get_td_class_text(row, "season")
-        if season_str:
-            season_begin, season_end = parse_season(season_str)
+def parse_int(text, default=0):
+    try:
+        return int(text)
+    except ValueError:
+        return default
 
-        if season_end > datetime.now().year:
-            continue
 
-        stats = StatLine()
-        stats.season_begin = season_begin
-        stats.season_end = season_end
-        stats.team_name = get_td_class_text(row, "team")
-        stats.league_name = get_td_class_text(row, "league")
-        stats.games = get_td_class_int(row, "gp")
-        stats.is_tournament = is_tournament(row)
+def parse_float(text):
+    return try_parse(text, float)
 
-        stats.goals = get_td_class_int(row, "g")
-        stats.assists = get_td_class_int(row, "a")
-        stats.plus_minus = get_td_class_int(row, "pm")
 
-        player.stats.append(stats)
+# (attribute of StatLine, class of the td, conversion of the cell text)
+COMMON_FIELDS = [("team_name", "team", str), ("league_name", "league", str), ("games", "gp", parse_int)]
+SKATER_FIELDS = COMMON_FIELDS + [
+    ("goals", "g", parse_int),
+    ("assists", "a", parse_int),
+    ("plus_minus", "pm", parse_int),
+]
+GOALIE_FIELDS = COMMON_FIELDS + [("goal_average", "gaa", parse_float), ("save_percent", "svp", parse_float)]
 
 
-def parse_goalie_stats(seasons, player):
+def index_columns(cells):
+    """
+    Map each td class to the position of the first cell having it.
+    """
+    columns = {}
+    for idx, cell in enumerate(cells):
+        for cls in cell.get("class", []):
+            columns.setdefault(cls, idx)
+    return columns
+
+
+def parse_stats(seasons, player, fields):
+    current_year = datetime.now().year
+    # rows of the stats table share a few layouts, the map of each layout is built once. The layout is the classes
+    # of the cells, rows of the same width can still order their columns differently.
+    layouts = {}
+
     for row in seasons:
-        season_str = get_td_class_text(row, "season")
+        cells = row.find_all("td")
+        layout = tuple(tuple(cell.get("class", ())) for cell in cells)
+        columns = layouts.get(layout)
+        if columns is None:
+            columns = layouts[layout] = index_columns(cells)
+
+        def cell_text(cls):
+            idx = columns.get(cls)
+            return "" if idx is None else get_element_text(cells[idx])
+
+        season_str = cell_text("season")
         if season_str:
             season_begin, season_end = parse_season(season_str)
 
-        if season_end > datetime.now().year:
+        if season_end > current_year:
             continue
 
-        stats = StatLine()
-        stats.season_begin = season_begin
-        stats.season_end = season_end
-        stats.team_name = get_td_class_text(row, "team")
-        stats.league_name = get_td_class_text(row, "league")
-        stats.games = get_td_class_int(row, "gp")
-        stats.is_tournament = is_tournament(row)
-
-        stats.goal_average = try_parse(get_td_class_text(row, "gaa"), float)
-        stats.save_percent = try_parse(get_td_class_text(row, "svp"), float)
+        stats = StatRecord(season_begin=season_begin, season_end=season_end, is_tournament=is_tournament(row))
+        for attr, cls, conv in fields:
+            setattr(stats, attr, conv(cell_text(cls)))
 
         player.stats.append(stats)
 
 
+def parse_skater_stats(seasons, player):
+    parse_stats(seasons, player, SKATER_FIELDS)
+
+
+def parse_goalie_stats(seasons, player):
+    parse_stats(seasons, player, GOALIE_FIELDS)
+
+
 def parse_data_col(row):
     label, data = row.find_all("div")
     return get_element_text(data)
@@ -149,87 +199,329 @@ def draft_from_str(draft_str):
     match = RE_DRAFT_STR.match(draft_str)
     if not match:
         raise ValueError("invalid draft string")
-    return Draft(year=int(match.group(1)), round=int(match.group(2)), overall=int(match.group(3)), team=match.group(4))
+    return DraftRecord(
+        year=int(match.group(1)), round=int(match.group(2)), overall=int(match.group(3)), team=match.group(4)
+    )
 
 
-class Scraper:
-    def __init__(self):
-        self._client = CachingClient(cache_duration=timedelta(hours=24), delay=5)
+def parse_player_dom(doc, url, name=None, position=None):
+    info_table = doc.find("div", class_="table-view")
+    table_div, extra_div = info_table.find_all("div", recursive=False)
+    left_side, right_side = table_div.find_all("div", recursive=False)
 
-    def parse_player(self, url, name=None, position=None):
-        logger.info("Processing player at %s", url)
+    if name is None:
+        name = get_element_text(doc.find(class_="plytitle").find_all(text=True, recursive=False))
 
-        doc = create_dom(self._client.get(url).text)
-        info_table = doc.find("div", class_="table-view")
-        table_div, extra_div = info_table.find_all("div", recursive=False)
-        left_side, right_side = table_div.find_all("div", recursive=False)
+    player = PlayerRecord(name=name)
 
-        if name is None:
-            name = get_element_text(doc.find(class_="plytitle").find_all(text=True, recursive=False))
+    sections = extra_div.find_all("li")
 
-        player = Player(name=name)
+    for section in sections:
+        first, second, *_rest = section.find_all("div")
+        if "drafted" in get_element_text(first).lower():
+            player.drafts.append(draft_from_str(get_element_text(second)))
+    scouting_report = get_element_text(doc.find("div", class_="dtl-txt"))
 
-        sections = extra_div.find_all("li")
+    rows = left_side.find_all("li")
 
-        for section in sections:
-            first, second, *_rest = section.find_all("div")
-            if "drafted" in get_element_text(first).lower():
-                player.drafts.append(draft_from_str(get_element_text(second)))
-        scouting_report = get_element_text(doc.find("div", class_="dtl-txt"))
+    player.birthday = parse_birthday(parse_data_col(rows[0]))
+    player.birthplace = parse_data_col(rows[2])
+    player.nation = parse_data_col(rows[3])
 
-        rows = left_side.find_all("li")
+    rows = right_side.find_all("li")
 
-        player.birthday = parse_birthday(parse_data_col(rows[0]))
-        player.birthplace = parse_data_col(rows[2])
-        player.nation = parse_data_col(rows[3])
+    player.height = parse_data_col(rows[1])
+    player.weight = parse_data_col(rows[2])
+    player.shoots = Shoots.from_str(parse_data_col(rows[3]))
+    if position is None:
+        positions_str = parse_data_col(rows[0])
+        position = pick_best_position(positions_str)
+    player.position = position
 
-        rows = right_side.find_all("li")
+    player.url = url
+    player.ep_id = ep_id_from_url(url)
+    player.scouting_report = scouting_report
 
-        player.height = parse_data_col(rows[1])
-        player.weight = parse_data_col(rows[2])
-        player.shoots = Shoots.from_str(parse_data_col(rows[3]))
-        if position is None:
-            positions_str = parse_data_col(rows[0])
-            position = pick_best_position(positions_str)
-        player.position = position
+    seasons = doc.find("table", class_="player-stats").find("tbody").find_all("tr")
+
+    if Position.GOALIE != position:
+        parse_skater_stats(seasons, player)
+    else:
+        parse_goalie_stats(seasons, player)
 
-        player.url = url
-        player.scouting_report = scouting_report
+    return player
 
-        seasons = doc.find("table", class_="player-stats").find("tbody").find_all("tr")
 
-        if Position.GOALIE != position:
-            parse_skater_stats(seasons, player)
+def parse_depth_chart_dom(doc):
+    """
+    Return the (url, name, position) of each player listed in a depth chart.
+    """
+    table = doc.find("table", class_="depth-chart")
+    rows = []
+    for body in table.find_all("tbody"):
+        for row in body.find_all("tr"):
+            rows.append(row)
+
+    jobs = []
+    current_position = None
+
+    for row in rows:
+        if "title" in row.attrs.get("class", []):
+            current_position = Position.from_str(get_element_text(row))
         else:
-            parse_goalie_stats(seasons, player)
+            player_str = get_element_text(row.find("td", class_="player"))
+            name, _ = parse_player_string(player_str)
+            url = row.find("a").attrs["href"]
+            jobs.append((url, name, current_position))
+
+    return jobs
+
+
+def parse_league_dom(doc):
+    """
+    Return the depth chart url of each team linked from a league page, in order of appearance.
+    """
+    urls = []
+    for link in doc.find_all("a", href=True):
+        match = RE_TEAM_URL.match(link["href"])
+        if match:
+            url = match.group(1) + "/depth-chart"
+            if url not in urls:
+                urls.append(url)
+    return urls
+
+
+def _parse_player_html(job):
+    """
+    Parse a player page in a worker process. Returns `(url, record or None, parse time in seconds)`, the time is
+    logged by the parent process whose logging is configured.
+    """
+    html, url, name, position, parser = job
+    start = time.perf_counter()
+    try:
+        player = parse_player_dom(create_dom(html, parser, PLAYER_REGIONS), url, name, position)
+    except Exception:
+        logger.exception("Failed to parse player at %s", url)
+        player = None
+    return url, player, time.perf_counter() - start
+
+
+_DONE = object()
 
-        return player
+
+class Scraper:
+    def __init__(self, workers=4, flush_size=500, parser=None, processes=None, queue_size=32, profile=None):
+        self._client = CachingClient(cache_duration=timedelta(hours=24), delay=5, pool_size=workers, profile=profile)
+        self._workers = workers
+        self._flush_size = flush_size
+        self._parser = parser or DEFAULT_PARSER
+        self._processes = processes
+        self._queue_size = queue_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._client.close()
+
+    def _get_dom(self, url, parse_only=None):
+        html = self._client.get(url).text
+        start = time.perf_counter()
+        doc = create_dom(html, self._parser, parse_only)
+        self._log_parse_time(url, time.perf_counter() - start)
+        return doc
+
+    def _log_parse_time(self, url, elapsed):
+        logger.info("Parsed %s with %s in %.1f ms", url, self._parser, elapsed * 1000)
+
+    def _log_parse_summary(self, count, elapsed):
+        if count:
+            logger.info(
+                "Parsed %d player pages with %s, %.1f ms per page on average",
+                count,
+                self._parser,
+                elapsed / count * 1000,
+            )
+
+    def parse_player(self, url, name=None, position=None):
+        logger.info("Processing player at %s", url)
+        return parse_player_dom(self._get_dom(url, PLAYER_REGIONS), url, name, position)
+
+    def scrape_players(self, db, jobs, on_done=None, on_failed=None):
+        """
+        Scrape the (url, name, position) jobs into the database with a three stage pipeline:
+
+        * `workers` threads fetch the pages, the client's rate limiter spaces out the network requests;
+        * a process pool parses the pages into plain records;
+        * a single thread writes the records in batches.
+
+        Stages are connected by queues bounded by `queue_size`, a slow stage blocks the ones before it. The
+        threads are daemons, an interrupted run only keeps the batches which were already committed.
+        `on_done` is called with the urls of each committed batch, `on_failed` with the url of each player
+        which could not be fetched or parsed. Returns the number of players written.
+        """
+        todo = queue.Queue()
+        for job in jobs:
+            todo.put(job)
+        fetched = queue.Queue(maxsize=self._queue_size)
+        parsed = queue.Queue(maxsize=self._queue_size)
+        errors = []
+        written = [0]
+        parse_time = [0, 0.0]
+
+        def fetch():
+            while True:
+                try:
+                    url, name, position = todo.get_nowait()
+                except queue.Empty:
+                    return
+                logger.info("Processing player at %s", url)
+                try:
+                    html = self._client.get(url).text
+                except Exception:
+                    logger.exception("Failed to fetch player at %s", url)
+                    if on_failed is not None:
+                        on_failed(url)
+                    continue
+                fetched.put((html, url, name, position, self._parser))
+
+        def close_fetched(fetchers):
+            for thread in fetchers:
+                thread.join()
+            fetched.put(_DONE)
+
+        def flushed(players):
+            if on_done is not None:
+                on_done([player.url for player in players])
+
+        def write():
+            done = False
+            try:
+                with db.writer(flush_size=self._flush_size, on_flush=flushed) as writer:
+                    while not done:
+                        item = parsed.get()
+                        if item is _DONE:
+                            done = True
+                            continue
+                        url, player, elapsed = item
+                        self._log_parse_time(url, elapsed)
+                        parse_time[0] += 1
+                        parse_time[1] += elapsed
+                        if player is not None:
+                            writer.add(player)
+                            written[0] += 1
+                        elif on_failed is not None:
+                            on_failed(url)
+            except Exception as e:
+                errors.append(e)
+                # keep draining the queue after an error, otherwise the parse stage would block forever
+                while not done:
+                    done = parsed.get() is _DONE
+
+        processes = self._processes or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            # start the worker processes before any thread, forking a process while threads hold locks is unsafe
+            list(executor.map(abs, range(processes)))
+
+            writer_thread = threading.Thread(target=write, name="writer", daemon=True)
+            writer_thread.start()
+            fetchers = [
+                threading.Thread(target=fetch, name="fetch-{}".format(i), daemon=True) for i in range(self._workers)
+            ]
+            for thread in fetchers:
+                thread.start()
+            threading.Thread(target=close_fetched, args=(fetchers,), name="fetch-close", daemon=True).start()
+
+            pending = deque()
+            while True:
+                job = fetched.get()
+                if job is _DONE:
+                    break
+                pending.append(executor.submit(_parse_player_html, job))
+                while len(pending) >= self._queue_size or (pending and pending[0].done()):
+                    parsed.put(pending.popleft().result())
+            while pending:
+                parsed.put(pending.popleft().result())
+
+        parsed.put(_DONE)
+        writer_thread.join()
+        # the last access of the cache hits is buffered, it must be written for `cache limit` to evict the right pages
+        self._client.flush()
+        self._log_parse_summary(*parse_time)
+        if errors:
+            raise errors[0]
+        return written[0]
+
+    def client_stats(self):
+        return self._client.stats()
+
+    def client_memory_stats(self):
+        return self._client.memory_stats()
+
+    def parse_league(self, url):
+        return parse_league_dom(self._get_dom(url))
 
     def parse_depth_chart(self, db, url):
-        doc = create_dom(self._client.get(url).text)
-
-        table = doc.find("table", class_="depth-chart")
-        rows = []
-        for body in table.find_all("tbody"):
-            for row in body.find_all("tr"):
-                rows.append(row)
-
-        players = []
-        current_position = None
-
-        with db.session() as sess:
-            for row in rows:
-                if "title" in row.attrs.get("class", []):
-                    current_position = Position.from_str(get_element_text(row))
-                else:
-                    player_str = get_element_text(row.find("td", class_="player"))
-                    name, _ = parse_player_string(player_str)
-                    url = row.find("a").attrs["href"]
-                    player = self.parse_player(url, name, current_position)
-                    sess.merge(player)
-                    sess.commit()
-
-        return players
+        return self.parse_depth_charts(db, [url])
+
+    def parse_depth_charts(self, db, urls, on_done=None):
+        """
+        Scrape the players of several depth charts in one pipeline. A player listed on several charts is only
+        scraped once, with the name and position of the first chart listing it.
+        """
+        jobs = OrderedDict()
+        for url in urls:
+            for player_url, name, position in parse_depth_chart_dom(self._get_dom(url, DEPTH_CHART_REGIONS)):
+                jobs.setdefault(player_url, (player_url, name, position))
+        logger.info("Found %d distinct players in %d depth charts", len(jobs), len(urls))
+        return self.scrape_players(db, list(jobs.values()), on_done=on_done)
+
+    def reparse(self, db, processes=None):
+        """
+        Rebuild the player database from scratch using only the documents in the request cache, stale or not.
+        Names and positions come from the cached depth charts when a player appears in one.
+        """
+        charts = {}
+        for resp in self._client.iter_cached("%/depth-chart%"):
+            for url, name, position in parse_depth_chart_dom(create_dom(resp.text, self._parser, DEPTH_CHART_REGIONS)):
+                charts[url] = (name, position)
+
+        jobs = (
+            (resp.text, resp.url) + charts.get(resp.url, (None, None)) + (self._parser,)
+            for resp in self._client.iter_cached("%/player/%")
+        )
+
+        db.unlink()
+        count = 0
+        parse_time = [0, 0.0]
+
+        def collect(future):
+            url, player, elapsed = future.result()
+            self._log_parse_time(url, elapsed)
+            parse_time[0] += 1
+            parse_time[1] += elapsed
+            if player is not None:
+                writer.add(player)
+                return 1
+            return 0
+
+        with ProcessPoolExecutor(max_workers=processes) as executor, db.writer(flush_size=self._flush_size) as writer:
+            # executor.map would submit every page of the cache up front, at most `queue_size` pages are decoded
+            # and waiting for a worker at any time
+            pending = deque()
+            for job in jobs:
+                pending.append(executor.submit(_parse_player_html, job))
+                while len(pending) >= self._queue_size or (pending and pending[0].done()):
+                    count += collect(pending.popleft())
+            while pending:
+                count += collect(pending.popleft())
+
+        self._log_parse_summary(*parse_time)
+        logger.info("Rebuilt %d players from the request cache", count)
+        return count
 
 
 __all__ = ["Scraper"]
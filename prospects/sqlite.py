@@ -1,15 +1,40 @@
+import logging
 import os
+from collections import OrderedDict
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine, event
+from sqlalchemy import bindparam, create_engine, event, select
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from .models import Draft, Player, StatLine, refresh_season_summary
+from .pragmas import apply_pragmas
+
+logger = logging.getLogger(__name__)
+
+# stay below SQLITE_MAX_VARIABLE_NUMBER (999 on older builds) for IN clauses
+_IN_CHUNK_SIZE = 500
+
+
+def _chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i : i + size]
+
+
+def _row(table, obj, **extra):
+    row = {col.key: getattr(obj, col.key) for col in table.columns if not col.primary_key and not col.foreign_keys}
+    row.update(extra)
+    return row
 
 
 class SqliteDB:
-    def __init__(self, path, metadata, echo=False):
+    def __init__(self, path, metadata, echo=False, *, version=0, migrate=None, profile=None):
         self.path = path
         self.metadata = metadata
         self.echo = echo
+        self.version = version
+        self.migrate = migrate
+        self.profile = profile
 
         self._engine = None
         self._session_factory = None
@@ -26,8 +51,22 @@ class SqliteDB:
         except FileNotFoundError:
             pass
 
+        for suffix in ("-wal", "-shm"):
+            try:
+                os.unlink(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
     def _connect(self):
-        engine = create_engine("sqlite:///{}".format(self.path), echo=self.echo)
+        # SQLAlchemy defaults to NullPool for SQLite files, which reconnects for every transaction: the pragmas
+        # would be applied again and the page cache and memory map thrown away each time. Pooled connections are
+        # used by one thread at a time, the same thread check of sqlite3 is not needed.
+        engine = create_engine(
+            "sqlite:///{}".format(self.path),
+            echo=self.echo,
+            poolclass=QueuePool,
+            connect_args={"check_same_thread": False},
+        )
 
         # https://docs.sqlalchemy.org/en/13/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
         # https://docs.sqlalchemy.org/en/13/dialects/sqlite.html#foreign-key-support
@@ -38,13 +77,29 @@ class SqliteDB:
             cur = dbapi_connection.cursor()
             cur.execute("PRAGMA foreign_keys=ON")
             cur.close()
+            apply_pragmas(dbapi_connection, self.profile)
 
         @event.listens_for(engine, "begin")
         def do_begin(conn):
             conn.execute("BEGIN")
 
+        with engine.connect() as conn:
+            version = conn.execute("PRAGMA user_version").scalar()
+
+        # a database stamped with the current version already has its schema, create_all would only cost a
+        # query per table on every start
+        if version and version >= self.version:
+            return engine
+
         self.metadata.create_all(engine)
 
+        with engine.begin() as conn:
+            version = conn.execute("PRAGMA user_version").scalar()
+            if version < self.version:
+                if self.migrate is not None:
+                    self.migrate(conn, version)
+                conn.execute("PRAGMA user_version = {}".format(self.version))
+
         return engine
 
     def _get_engine(self):
@@ -69,3 +124,136 @@ class SqliteDB:
             raise
         finally:
             session.close()
+
+    @contextmanager
+    def transaction(self):
+        with self._get_engine().begin() as conn:
+            yield conn
+
+    def writer(self, flush_size=500, on_flush=None):
+        return PlayerWriter(self, flush_size=flush_size, on_flush=on_flush)
+
+
+class PlayerWriter:
+    """
+    Buffers scraped players, `PlayerRecord` or `Player` objects, and writes them along with their drafts and
+    stat lines in one transaction per `flush_size` players using executemany statements. Players are matched
+    on their EliteProspects id, drafts on their year and stat lines on (season, team, league, tournament).
+    Only rows which changed are written. `on_flush` is called with the players of each batch once it is committed.
+    """
+
+    def __init__(self, db, flush_size=500, on_flush=None):
+        self._db = db
+        self._flush_size = flush_size
+        self._on_flush = on_flush
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, player):
+        self._pending.append(player)
+        if len(self._pending) >= self._flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        players, self._pending = self._pending, []
+        with self._db.transaction() as conn:
+            self._write(conn, players)
+        if self._on_flush is not None:
+            self._on_flush(players)
+
+    def _select_in(self, conn, table, column, values):
+        for chunk in _chunks(values, _IN_CHUNK_SIZE):
+            yield from conn.execute(select([table]).where(column.in_(chunk)))
+
+    def _upsert(self, conn, table, existing, rows):
+        """
+        Diff `rows` against the `existing` rows having the same key, update the rows that changed, insert
+        the new ones and delete the existing rows which are gone. Returns the keys of the rows written.
+        """
+        inserts = []
+        updates = []
+        deletes = []
+        changed = set()
+
+        for key, new_rows in rows.items():
+            old_rows = existing.get(key, [])
+            for old, new in zip(old_rows, new_rows):
+                if any(old[col] != val for col, val in new.items()):
+                    updates.append(dict(new, _id=old.id))
+                    changed.add(key)
+            if len(new_rows) != len(old_rows):
+                inserts.extend(new_rows[len(old_rows) :])
+                deletes.extend(old.id for old in old_rows[len(new_rows) :])
+                changed.add(key)
+
+        for key, old_rows in existing.items():
+            if key not in rows:
+                deletes.extend(old.id for old in old_rows)
+                changed.add(key)
+
+        if updates:
+            conn.execute(table.update().where(table.c.id == bindparam("_id")), updates)
+        if inserts:
+            conn.execute(table.insert(), inserts)
+        for chunk in _chunks(deletes, _IN_CHUNK_SIZE):
+            conn.execute(table.delete().where(table.c.id.in_(chunk)))
+
+        return changed
+
+    def _write_children(self, conn, table, key_cols, player_ids, rows):
+        existing = {}
+        for row in self._select_in(conn, table, table.c.player_id, player_ids):
+            key = (row.player_id,) + tuple(row[col] for col in key_cols)
+            existing.setdefault(key, []).append(row)
+
+        grouped = OrderedDict()
+        for row in rows:
+            key = (row["player_id"],) + tuple(row[col] for col in key_cols)
+            grouped.setdefault(key, []).append(row)
+
+        return self._upsert(conn, table, existing, grouped)
+
+    def _write(self, conn, players):
+        player_table = Player.__table__
+
+        # the last occurrence of a player in the batch wins
+        players = OrderedDict((player.ep_id, player) for player in players)
+        ep_ids = list(players.keys())
+
+        existing = {row.ep_id: [row] for row in self._select_in(conn, player_table, player_table.c.ep_id, ep_ids)}
+        rows = OrderedDict((ep_id, [_row(player_table, player)]) for ep_id, player in players.items())
+        changed_players = self._upsert(conn, player_table, existing, rows)
+
+        ids = {row.ep_id: row.id for row in self._select_in(conn, player_table, player_table.c.ep_id, ep_ids)}
+        player_ids = list(ids.values())
+
+        drafts = []
+        stats = []
+        for ep_id, player in players.items():
+            player_id = ids[ep_id]
+            drafts.extend(_row(Draft.__table__, draft, player_id=player_id) for draft in player.drafts)
+            stats.extend(_row(StatLine.__table__, stat, player_id=player_id) for stat in player.stats)
+
+        changed_drafts = self._write_children(conn, Draft.__table__, Draft.natural_key, player_ids, drafts)
+        changed_stats = self._write_children(conn, StatLine.__table__, StatLine.natural_key, player_ids, stats)
+
+        # keys of the children start with the player id, only the summaries of those players are rebuilt
+        refreshed = sorted({key[0] for key in changed_stats})
+        refresh_season_summary(conn, refreshed)
+
+        logger.debug(
+            "flushed %d players: %d players, %d drafts and %d stat lines changed, %d season summaries refreshed",
+            len(players),
+            len(changed_players),
+            len(changed_drafts),
+            len(changed_stats),
+            len(refreshed),
+        )